@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+#
+# Compares compute_difference_over_dictonaries with the DeltaEngine on the
+# deltas of a ps dump of about 20k processes, as computed for every process
+# on each tick, and on 5k memory cgroups with tasks and stat. The dump is
+# recorded like in ps_parse.py or read from a file given as argument.
+#
+#   python3 benchmarks/delta_engine.py [DUMP]
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from collector.sources.ps import LinuxPS
+from collector.sources import compute_difference_over_dictonaries
+from collector.sources.delta import delta_engine
+from ps_parse import record_dump, measure
+
+GROUPS = 5000
+
+def next_tick(pids):
+	r = { }
+
+	for pid in pids:
+		r[pid] = pids[pid].copy()
+		for field in ["time", "min_flt", "maj_flt", "rss"]:
+			if field in r[pid]:
+				r[pid][field] += 1
+
+	return r
+
+def memory_groups(tick):
+	r = { }
+
+	for i in range(0, GROUPS):
+		stat = dict([("counter%i" % (j), i*j+tick) for j in range(0, 40)])
+		r["/group%i" % (i)] = {
+			"tasks": list(range(i, i+20)),
+			"usage_in_bytes": i*4096+tick,
+			"limit_in_bytes": 9223372036854771712,
+			"stat": stat,
+		}
+
+	return r
+
+def compare(title, new, old):
+	old_states = dict([(key, delta_engine.snapshot(old[key])) for key in old])
+
+	def legacy():
+		for key in new:
+			compute_difference_over_dictonaries(new[key], old[key], 5.0)
+
+	def engine():
+		for key in new:
+			delta_engine.difference(delta_engine.snapshot(new[key]), old_states[key], 5.0)
+
+	t_legacy = measure(legacy)
+	t_engine = measure(engine)
+
+	print("%s: %i" % (title, len(new)))
+	print("  compute_difference: %8.1f ms" % (t_legacy*1000.0))
+	print("  delta engine:       %8.1f ms" % (t_engine*1000.0))
+	print("  speedup:            %8.1fx" % (t_legacy/t_engine))
+
+if __name__ == "__main__":
+	ps = LinuxPS()
+
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], "rb") as f:
+			dump = f.read()
+	else:
+		dump = record_dump(ps)
+
+	ps.parse(dump)
+	compare("processes", next_tick(ps.pids), ps.pids)
+	compare("memory cgroups", memory_groups(1), memory_groups(0))
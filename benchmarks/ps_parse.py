@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+#
+# Compares the regex based ps parser with the compiled one of PS.parse on a
+# ps dump of about 20k lines. The dump is recorded from the local ps output
+# and repeated with shifted pids, or read from a file given as argument.
+#
+#   python3 benchmarks/ps_parse.py [DUMP]
+
+import os, re, sys, time
+from subprocess import check_output
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from collector.sources.ps import LinuxPS
+
+LINES = 20000
+ROUNDS = 5
+
+regex_compress = re.compile("( )+")
+regex_begin = re.compile("^( )+")
+
+def legacy_parse(ps, output):
+	pids = { }
+	lines = output.decode("UTF-8").split("\n")[1:]
+
+	for line in lines:
+		d = regex_compress.sub(" ", line)
+		d = regex_begin.sub("", d)
+		ar = d.split(" ", len(ps.fields)-1)
+		if len(d) == 0 or len(d[0]) == 0:
+			continue
+
+		data = { }
+		pid = None
+		for i in range(0, len(ps.fields)):
+			field = ps.fields[i].lower()
+
+			if field == "pid":
+				pid = ar[i]
+			else:
+				if ar[i] == "-":
+					continue
+
+				if field in ps.field_converter:
+					v = ps.field_converter[field](ar[i])
+					if v != None:
+						data[field] = v
+
+					continue
+
+			data[field] = ar[i]
+
+		if pid != None:
+			pids[pid] = data
+
+	return pids
+
+def record_dump(ps):
+	output = check_output([ps.command]+ps.arguments).decode("UTF-8").rstrip("\n").split("\n")
+	header, body = output[0], output[1:]
+	lines = [header]
+
+	n = 0
+	while len(lines) <= LINES:
+		for line in body:
+			pid = line.split(None, 1)[0]
+			lines += [line.replace(pid, str(int(pid)+n*100000), 1)]
+
+		n += 1
+
+	return ("\n".join(lines[:LINES+1])+"\n").encode("UTF-8")
+
+def measure(func):
+	best = None
+
+	for i in range(0, ROUNDS):
+		start = time.perf_counter()
+		func()
+		t = time.perf_counter()-start
+		if best == None or t < best:
+			best = t
+
+	return best
+
+if __name__ == "__main__":
+	ps = LinuxPS()
+
+	if len(sys.argv) > 1:
+		with open(sys.argv[1], "rb") as f:
+			dump = f.read()
+	else:
+		dump = record_dump(ps)
+
+	def compiled():
+		ps.pids = { }
+		ps.parse(dump)
+
+	legacy = measure(lambda: legacy_parse(ps, dump))
+	new = measure(compiled)
+
+	print("lines: %i, fields: %i" % (dump.count(b"\n")-1, len(ps.fields)))
+	print("regex parser:    %8.1f ms" % (legacy*1000.0))
+	print("compiled parser: %8.1f ms" % (new*1000.0))
+	print("speedup:         %8.1fx" % (legacy/new))
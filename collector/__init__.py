@@ -2,42 +2,112 @@
 # vim: noet shiftwidth=4 tabstop=4
 
 from datetime import datetime
-import socket, hashlib, json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import socket, hashlib, time, logging
+
+# looked up once, it is part of every envelope
+HOSTNAME = socket.gethostname()
 
 class Target:
 	def __init__(self, target):
 		self.target = target
+		# seconds a push may take, for targets doing network I/O
+		self.timeout = None
 
 	def push(self, doc):
 		None
 
+	def push_batch(self, batch):
+		for doc in batch:
+			self.push(doc)
+
+	def push_confirmed(self, batch, done):
+		"""
+		Pushes batch and calls done(delivered, failed, error) once its
+		documents were delivered or failed: the number of documents
+		delivered, a list of the documents worth delivering again and the
+		exception of the failure or None. Documents in neither were rejected
+		for good. Targets sending asynchronously call done from their threads.
+		"""
+		try:
+			self.push_batch(batch)
+		except Exception as e:
+			done(0, batch.docs, e)
+			return
+
+		done(len(batch), [], None)
+
+	def available(self):
+		"""
+		Whether the target is believed to accept documents.
+		"""
+		return True
+
+	def close(self):
+		"""
+		Sends documents still buffered by the target.
+		"""
+		None
+
 class Document:
 	ID_HASH_ALGO = "sha256"
+	ID_DIGEST_SIZE = 16
+	# "key" derives the id from the natural key of a document, "content" from
+	# its whole data
+	ID_STRATEGY = "key"
 
-	def __init__(self, source, doc_id=None, doc_type=None, doc_data=None):
+	def __init__(self, source, doc_id=None, doc_type=None, doc_data=None, key=None, envelope=None):
 		self.source = source
 		self.doc_type = doc_type
 		self.doc_data = doc_data
+		# fields shared with other documents of the same collection, like host
+		# and time, merged into data()
+		self.envelope = envelope
+		# e.g. group path or pid, see Source.document_key. Host and collection
+		# time are taken from the envelope once the id is computed
+		self.key = key
+		# computed on first use
+		self.doc_id = doc_id
 
-		if doc_id == None:
-			h = hashlib.new(Document.ID_HASH_ALGO)
-			if doc_data == None:
-				self.doc_id = None
-			else:
-				h.update(repr(self.doc_data).encode("ASCII", errors="ignore"))
-				self.doc_id = h.hexdigest()
+	def compute_id(self):
+		if self.doc_data == None:
+			return None
+
+		if Document.ID_STRATEGY == "key" and self.key != None:
+			h = hashlib.blake2b(digest_size=Document.ID_DIGEST_SIZE)
+			key = [self.source, self.doc_type]
+			if self.envelope != None:
+				key += [self.envelope.get("host"), self.envelope.get("collected", { }).get("utc")]
 
+			key += list(self.key)
+			h.update("\0".join([str(k) for k in key]).encode("UTF-8", errors="replace"))
 		else:
-			self.doc_id = doc_id
+			h = hashlib.new(Document.ID_HASH_ALGO)
+			h.update(repr(self.data()).encode("ASCII", errors="ignore"))
 
+		return h.hexdigest()
 
 	def id(self):
+		if self.doc_id == None:
+			self.doc_id = self.compute_id()
+
 		return self.doc_id
 
 	def type(self):
 		return self.doc_type
 
 	def data(self):
+		if self.envelope == None:
+			return self.doc_data
+
+		d = self.envelope.copy()
+		d.update(self.doc_data)
+		return d
+
+	def payload(self):
+		"""
+		Data of the document without the envelope.
+		"""
 		return self.doc_data
 
 	def __str__(self):
@@ -47,11 +117,40 @@ class Document:
 			"data": self.data(),
 		})
 
+class DocumentBatch:
+	"""
+	Documents of a source from one collection. The envelope, host and
+	collection time, is held once and shared by the documents.
+	"""
+
+	def __init__(self, source, envelope=None, docs=None):
+		self.source = source
+		self.envelope = envelope
+		self.docs = docs if docs != None else []
+
+	def add(self, doc):
+		self.docs += [doc]
+
+	def __iter__(self):
+		return iter(self.docs)
+
+	def __len__(self):
+		return len(self.docs)
+
 class Source:
 	def __init__(self, name):
 		self.name = name
 		self.timestamp = datetime.utcnow()
 		self.last_timestamp = datetime.utcnow()
+		# seconds a collection may take, None for the default of the Collector
+		self.deadline = None
+		# seconds between collections and offset of the first one, None for
+		# the defaults of the Scheduler
+		self.interval = None
+		self.phase = None
+		# base information and the timestamp it was computed for
+		self.envelope = None
+		self.envelope_timestamp = None
 
 	def update(self):
 		self.last_timestamp = self.timestamp
@@ -60,14 +159,38 @@ class Source:
 	def docs(self):
 		return []
 
+	def batch(self):
+		docs = self.docs()
+		return DocumentBatch(self.name, self.get_base_information(), docs)
+
+	def document_key(self, *parts):
+		"""
+		Natural key of a document of this source, parts identify the document
+		within a collection. Completed by host and collection time of the
+		envelope when the id is computed.
+		"""
+		return parts
+
 	def get_timedelta(self):
 		return (self.timestamp-self.last_timestamp).total_seconds()
 
+	def close(self):
+		"""
+		Releases processes, files and threads held by the source.
+		"""
+		None
+
 	def get_base_information(self):
-		utcdelta = datetime.now()-datetime.utcnow()
+		"""
+		Envelope of the documents of the current collection, computed once
+		per timestamp and shared, it must not be modified.
+		"""
+		if self.envelope_timestamp == self.timestamp:
+			return self.envelope
 
-		return {
-			"host": socket.gethostname(),
+		self.envelope_timestamp = self.timestamp
+		self.envelope = {
+			"host": HOSTNAME,
 			"collected": {
 				"year": self.timestamp.year,
 				"hour": self.timestamp.hour,
@@ -80,10 +203,34 @@ class Source:
 			}
 		}
 
+		return self.envelope
+
 class Collector:
-	def __init__(self, sources=[], targets=[]):
+	"""
+	Collects sources concurrently, batches are pushed to the targets as the
+	sources finish. A source missing its deadline is skipped for that run and
+	a Missed document is pushed instead, it isn't started again before the
+	late collection finished. A source failing gets a Missed document too,
+	the other sources aren't affected.
+	"""
+
+	def __init__(self, sources=[], targets=[], deadline=None, pipeline=None):
 		self.sources = sources
 		self.targets = targets
+		# optional collector.pipeline.Pipeline batches are handed to instead
+		# of pushing them to the targets directly
+		self.pipeline = pipeline
+		# default deadline in seconds, None for the interval of the source or
+		# to wait for it
+		self.deadline = deadline
+		self.executor = None
+		self.workers = 0
+		# source -> future of its current collection
+		self.running = { }
+		# future -> (source, monotonic deadline), not yet pushed
+		self.pending = { }
+		self.source = Source("Collector")
+		self.log = logging.getLogger(__name__)
 
 	def add_source(self, s):
 		self.sources += [s]
@@ -91,14 +238,135 @@ class Collector:
 	def add_target(self, t):
 		self.targets += [t]
 
-	def collect(self):
-		docs = 0
+	def get_executor(self):
+		if self.executor == None or self.workers < len(self.sources):
+			if self.executor != None:
+				self.executor.shutdown(wait=False)
+
+			self.workers = max(len(self.sources), 1)
+			self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+		return self.executor
+
+	def get_deadline(self, source):
+		if source.deadline != None:
+			return source.deadline
+		elif self.deadline != None:
+			return self.deadline
+		else:
+			return source.interval
+
+	def missed(self, source, reason):
+		"""
+		Batch marking a skipped collection of source.
+		"""
+		self.source.update()
+		envelope = self.source.get_base_information()
+		doc = Document(
+			self.source.name,
+			doc_type = "Missed",
+			doc_data = {
+				"name": source.name,
+				"Missed": {
+					"source": source.name,
+					"reason": reason,
+					"deadline": self.get_deadline(source),
+				},
+			},
+			key = self.source.document_key(source.name),
+			envelope = envelope
+		)
+
+		return DocumentBatch(source.name, envelope, [doc])
+
+	def push(self, batch):
+		if self.pipeline != None:
+			self.pipeline.push(batch)
+			return
+
+		for target in self.targets:
+			target.push_batch(batch)
+
+	def submit(self, source):
+		"""
+		Starts a collection of source, unless the last one is still running.
+		"""
+		future = self.running.get(source)
+		if future != None and not future.done():
+			self.push(self.missed(source, "busy"))
+			return
+
+		future = self.get_executor().submit(source.batch)
+		self.running[source] = future
+
+		deadline = self.get_deadline(source)
+		if deadline != None:
+			deadline += time.monotonic()
+
+		self.pending[future] = (source, deadline)
+
+	def poll(self, timeout=None):
+		"""
+		Pushes the batches of finished collections and marks missed
+		deadlines. Waits up to timeout seconds for a collection to finish,
+		None waits until one finishes or misses its deadline.
+		"""
+		if len(self.pending) == 0:
+			if timeout != None:
+				time.sleep(timeout)
+			return
+
+		now = time.monotonic()
+		deadlines = [d for s, d in self.pending.values() if d != None]
+		if len(deadlines) > 0:
+			left = max(min(deadlines)-now, 0)
+			if timeout == None or left < timeout:
+				timeout = left
+
+		done, not_done = wait(list(self.pending), timeout, return_when=FIRST_COMPLETED)
+
+		for future in list(self.pending):
+			source, deadline = self.pending[future]
+
+			if future in done:
+				del self.pending[future]
+				try:
+					batch = future.result()
+				except Exception:
+					self.log.exception("collecting %s failed", source.name)
+					batch = self.missed(source, "error")
+
+				self.push(batch)
+			elif deadline != None and time.monotonic() >= deadline:
+				del self.pending[future]
+				self.push(self.missed(source, "deadline"))
+
+	def collect(self, sources=None):
+		"""
+		Collects all or the given sources once and waits for them.
+		"""
+		if sources == None:
+			sources = self.sources
+
+		for source in sources:
+			self.submit(source)
+
+		while len(self.pending) > 0:
+			self.poll()
+
+	def close(self):
+		if self.executor != None:
+			self.executor.shutdown(wait=False)
+			self.executor = None
 
 		for source in self.sources:
-			for doc in source.docs():
-				for target in self.targets:
-					target.push(doc)
-					docs += 1
-		
-		# print("%i documents pushed to %i targets" % (docs, len(self.targets)))
+			source.close()
+
+		delivered = []
+		if self.pipeline != None:
+			self.pipeline.close()
+			delivered = self.pipeline.targets()
 
+		for target in self.targets:
+			if target not in delivered:
+				target.close()
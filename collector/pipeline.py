@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+
+from collector import DocumentBatch
+import threading, logging, time
+
+class BatchQueue:
+	"""
+	Bounded queue of DocumentBatches, its size is counted in documents. If a
+	batch doesn't fit, the policy decides: block waits for space, drop-oldest
+	drops queued documents, drop-newest documents of the new batch and spool
+	hands the new batch to overflow. A batch still not fitting after the
+	timeout of a blocking put is handed to overflow or dropped, later puts
+	don't wait until a batch was taken.
+	"""
+
+	POLICIES = ["block", "drop-oldest", "drop-newest", "spool"]
+
+	def __init__(self, capacity, policy="block"):
+		if policy not in BatchQueue.POLICIES:
+			raise ValueError("unknown overflow policy %s" % (policy))
+
+		self.capacity = max(capacity, 1)
+		self.policy = policy
+		self.batches = []
+		self.size = 0
+		self.closed = False
+		# a blocking put timed out and no batch was taken since
+		self.stalled = False
+		self.condition = threading.Condition()
+		# called with batches not fitting by the spool policy
+		self.overflow = None
+		# counters of documents
+		self.queued = 0
+		self.dropped = 0
+
+	def put(self, batch, timeout=None):
+		spill = None
+
+		with self.condition:
+			if self.policy == "spool":
+				if self.size > 0 and self.size+len(batch) > self.capacity:
+					spill = batch
+					batch = DocumentBatch(batch.source, batch.envelope)
+
+			elif self.policy == "block":
+				if timeout != None:
+					end = time.monotonic()+timeout
+
+				# a batch larger than the queue is taken once the queue is empty
+				while not self.closed and self.size > 0 and self.size+len(batch) > self.capacity:
+					if timeout == None:
+						self.condition.wait()
+						continue
+
+					left = end-time.monotonic()
+					if left <= 0 or self.stalled:
+						self.stalled = True
+						spill = batch
+						batch = DocumentBatch(batch.source, batch.envelope)
+						break
+
+					self.condition.wait(left)
+
+			elif self.policy == "drop-newest":
+				free = max(self.capacity-self.size, 0)
+				if len(batch) > free:
+					self.dropped += len(batch)-free
+					batch = DocumentBatch(batch.source, batch.envelope, batch.docs[:free])
+
+			else:
+				if len(batch) > self.capacity:
+					self.dropped += len(batch)-self.capacity
+					batch = DocumentBatch(batch.source, batch.envelope, batch.docs[-self.capacity:])
+
+				while self.size+len(batch) > self.capacity:
+					oldest = self.batches[0]
+					n = min(self.size+len(batch)-self.capacity, len(oldest))
+					self.dropped += n
+					self.size -= n
+					if n == len(oldest):
+						self.batches.pop(0)
+					else:
+						self.batches[0] = DocumentBatch(oldest.source, oldest.envelope, oldest.docs[n:])
+
+			if len(batch) > 0:
+				self.batches += [batch]
+				self.size += len(batch)
+				self.queued += len(batch)
+				self.condition.notify_all()
+
+		if spill != None:
+			if self.overflow != None:
+				self.overflow(spill)
+			else:
+				with self.condition:
+					self.dropped += len(spill)
+
+	def get(self, timeout=None):
+		"""
+		Returns the oldest batch, None if the queue is closed and empty or on
+		timeout.
+		"""
+		with self.condition:
+			if timeout != None:
+				end = time.monotonic()+timeout
+
+			while len(self.batches) == 0 and not self.closed:
+				if timeout == None:
+					self.condition.wait()
+				else:
+					left = end-time.monotonic()
+					if left <= 0:
+						return None
+
+					self.condition.wait(left)
+
+			if len(self.batches) == 0:
+				return None
+
+			batch = self.batches.pop(0)
+			self.size -= len(batch)
+			self.stalled = False
+			self.condition.notify_all()
+			return batch
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+class Delivery:
+	"""
+	Delivers batches to one target from a queue of its own, with worker
+	threads pushing concurrently. The timeout is handed to the target for its
+	I/O, pushes that time out or take longer until confirmed are counted.
+
+	With a collector.spool.Spool, documents failing to be delivered and
+	batches overflowing the queue by the spool policy are written to the
+	spool. They are replayed in order at up to replay_rate documents per
+	second while the target is up, a failing target is given a doubling
+	pause first. A replayed batch is removed from the spool once the target
+	confirmed it.
+	"""
+
+	MIN_PAUSE = 1.0
+	MAX_PAUSE = 60.0
+	# seconds between checks of an empty spool
+	REPLAY_POLL = 1.0
+
+	def __init__(self, target, capacity=10000, policy="drop-oldest", workers=1, timeout=None, spool=None, replay_rate=1000):
+		self.target = target
+		self.target.timeout = timeout
+		self.timeout = timeout
+		self.queue = BatchQueue(capacity, policy)
+		self.spool = spool
+		self.replay_rate = replay_rate
+		self.lock = threading.Lock()
+		self.log = logging.getLogger(__name__)
+		# counters of documents
+		self.delivered = 0
+		self.failed = 0
+		self.timed_out = 0
+		self.replayed = 0
+		# monotonic time the target is retried after a failure
+		self.paused_until = 0
+		self.pause = 0
+		self.closed = threading.Event()
+		self.workers = []
+
+		for i in range(0, workers):
+			t = threading.Thread(target=self.work, name="%s-%i" % (target.target, i), daemon=True)
+			t.start()
+			self.workers += [t]
+
+		self.replayer = None
+		if spool != None:
+			self.queue.overflow = self.write_spool
+			self.replayer = threading.Thread(target=self.replay, name="%s-replay" % (target.target), daemon=True)
+			self.replayer.start()
+
+	def work(self):
+		while True:
+			batch = self.queue.get()
+			if batch == None:
+				return
+
+			start = time.monotonic()
+			try:
+				self.target.push_confirmed(batch, lambda delivered, failed, error, batch=batch, start=start: self.confirmed(batch, start, delivered, failed, error))
+			except Exception as e:
+				self.confirmed(batch, start, 0, batch.docs, e)
+
+	def confirmed(self, batch, start, delivered, failed, error):
+		"""
+		Counts the outcome of a push, documents failing are spooled.
+		"""
+		timed_out = isinstance(error, TimeoutError) or (self.timeout != None and time.monotonic()-start > self.timeout)
+
+		with self.lock:
+			self.delivered += delivered
+			# rejected by the target for good
+			self.failed += len(batch)-delivered-len(failed)
+			if timed_out:
+				self.timed_out += len(batch)
+
+		if len(failed) == 0:
+			self.resume()
+			return
+
+		if isinstance(error, OSError):
+			self.log.warning("pushing to %s failed: %s", self.target.target, error)
+		else:
+			self.log.error("pushing to %s failed", self.target.target, exc_info=error)
+
+		self.suspend()
+		failed = DocumentBatch(batch.source, batch.envelope, failed)
+
+		if self.spool == None:
+			self.count(failed, False, False)
+		else:
+			self.write_spool(failed)
+
+	def write_spool(self, batch):
+		try:
+			self.spool.write(batch)
+		except OSError as e:
+			self.log.error("spooling for %s failed: %s", self.target.target, e)
+			self.count(batch, False, False)
+			return
+
+	def suspend(self):
+		with self.lock:
+			self.pause = min(max(self.pause*2, Delivery.MIN_PAUSE), Delivery.MAX_PAUSE)
+			self.paused_until = time.monotonic()+self.pause
+
+	def resume(self):
+		with self.lock:
+			self.pause = 0
+			self.paused_until = 0
+
+	def up(self):
+		return time.monotonic() >= self.paused_until and self.target.available()
+
+	def replay(self):
+		"""
+		Pushes the spooled batches in order, rate limited.
+		"""
+		next = time.monotonic()
+
+		while not self.closed.is_set():
+			if not self.up() or self.spool.empty():
+				self.closed.wait(Delivery.REPLAY_POLL)
+				continue
+
+			try:
+				r = self.spool.peek()
+			except (OSError, ValueError) as e:
+				self.log.error("reading the spool of %s failed: %s", self.target.target, e)
+				self.closed.wait(Delivery.REPLAY_POLL)
+				continue
+
+			if r == None:
+				continue
+
+			batch, position = r
+			outcome = []
+			done = threading.Event()
+
+			def confirm(delivered, failed, error):
+				outcome[:] = [delivered, failed, error]
+				done.set()
+
+			try:
+				self.target.push_confirmed(batch, confirm)
+			except Exception as e:
+				confirm(0, batch.docs, e)
+
+			done.wait()
+			delivered, failed, error = outcome
+
+			if len(failed) > 0:
+				# kept in the spool, replayed again once the target is up
+				self.log.warning("replaying to %s failed: %s", self.target.target, error)
+				self.suspend()
+				continue
+
+			self.spool.ack(position)
+			self.resume()
+			with self.lock:
+				self.replayed += delivered
+				self.delivered += delivered
+				self.failed += len(batch)-delivered
+
+			next = max(next, time.monotonic()) + len(batch)/float(self.replay_rate)
+			self.closed.wait(next-time.monotonic())
+
+	def count(self, batch, timed_out, delivered):
+		with self.lock:
+			if timed_out:
+				self.timed_out += len(batch)
+
+			if delivered:
+				self.delivered += len(batch)
+			else:
+				self.failed += len(batch)
+
+	def stats(self):
+		"""
+		Counters of documents, delivered and failed as confirmed by the
+		target, including the outcome of its sender threads.
+		"""
+		return {
+			"target": self.target.target,
+			"delivered": self.delivered,
+			"pending": self.queue.size,
+			"dropped": self.queue.dropped,
+			"failed": self.failed,
+			"timed_out": self.timed_out,
+			"spooled": self.spool.written if self.spool != None else 0,
+			"replayed": self.replayed,
+		}
+
+	def close(self, timeout=None):
+		"""
+		Delivers the queued batches and closes the target. Spooled batches are
+		kept for the next start.
+		"""
+		self.queue.close()
+		for t in self.workers:
+			t.join(timeout)
+
+		self.closed.set()
+		if self.replayer != None:
+			self.replayer.join(timeout)
+
+		self.target.close()
+		if self.spool != None:
+			self.spool.close()
+
+class Pipeline:
+	"""
+	Decouples sources from targets. Every target gets a Delivery, batches are
+	put into the queues of all targets, so a slow target falls behind or
+	sheds load by its overflow policy without delaying collections or the
+	other targets. Queues of the block policy hold up a push for at most
+	block_timeout seconds altogether.
+	"""
+
+	def __init__(self, targets=[], capacity=10000, policy="drop-oldest", workers=1, block_timeout=1.0):
+		# defaults for targets without options of their own
+		self.capacity = capacity
+		self.policy = policy
+		self.workers = workers
+		self.block_timeout = block_timeout
+		self.deliveries = []
+
+		for target in targets:
+			self.add_target(target)
+
+	def add_target(self, target, capacity=None, policy=None, workers=None, timeout=None, spool=None, replay_rate=1000):
+		if policy == None and spool != None:
+			policy = "spool"
+
+		self.deliveries += [Delivery(
+			target,
+			capacity = capacity if capacity != None else self.capacity,
+			policy = policy if policy != None else self.policy,
+			workers = workers if workers != None else self.workers,
+			timeout = timeout,
+			spool = spool,
+			replay_rate = replay_rate
+		)]
+
+	def targets(self):
+		return [d.target for d in self.deliveries]
+
+	def push(self, batch):
+		end = time.monotonic()+self.block_timeout
+		for d in self.deliveries:
+			d.queue.put(batch, max(end-time.monotonic(), 0))
+
+	def stats(self):
+		return [d.stats() for d in self.deliveries]
+
+	def close(self, timeout=None):
+		"""
+		Delivers the queued batches, stops the workers and closes the targets.
+		"""
+		for d in self.deliveries:
+			d.queue.close()
+
+		for d in self.deliveries:
+			d.close(timeout)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+
+import time
+
+class Scheduler:
+	"""
+	Runs the sources of a Collector, each at its own interval. Run times are
+	multiples of the interval on the monotonic clock, counted from a fixed
+	start, so collection time doesn't add up to drift. Runs missed by an
+	overrun are skipped. Sources sharing an interval are spread over it by
+	phase offsets, unless a source has a phase of its own.
+	"""
+
+	def __init__(self, collector, interval=None):
+		self.collector = collector
+		# for sources without an interval of their own, None runs them once
+		self.interval = interval
+		# source -> monotonic time of the next run, None if not run again
+		self.next_run = { }
+
+	def get_interval(self, source):
+		if source.interval != None:
+			return source.interval
+		else:
+			return self.interval
+
+	def plan(self, start):
+		by_interval = { }
+		for source in self.collector.sources:
+			interval = self.get_interval(source)
+			by_interval[interval] = by_interval.get(interval, []) + [source]
+
+		for interval in by_interval:
+			sources = by_interval[interval]
+			for i in range(0, len(sources)):
+				if sources[i].phase != None:
+					phase = sources[i].phase
+				elif interval != None:
+					phase = interval*i/len(sources)
+				else:
+					phase = 0
+
+				self.next_run[sources[i]] = start+phase
+
+	def advance(self, source, now):
+		interval = self.get_interval(source)
+		if interval == None or interval <= 0:
+			self.next_run[source] = None
+			return
+
+		t = self.next_run[source]+interval
+		if t <= now:
+			# skip the runs missed meanwhile, keep the phase
+			t += (int((now-t)/interval)+1)*interval
+
+		self.next_run[source] = t
+
+	def run_due(self, now):
+		for source in self.collector.sources:
+			t = self.next_run.get(source)
+			if t != None and t <= now:
+				self.collector.submit(source)
+				self.advance(source, now)
+
+	def run(self):
+		self.plan(time.monotonic())
+
+		while True:
+			self.run_due(time.monotonic())
+
+			runs = [t for t in self.next_run.values() if t != None]
+			if len(runs) == 0:
+				# all sources ran once, wait for them
+				while len(self.collector.pending) > 0:
+					self.collector.poll()
+				return
+
+			wakeup = min(runs)
+			now = time.monotonic()
+			while now < wakeup:
+				self.collector.poll(wakeup-now)
+				now = time.monotonic()
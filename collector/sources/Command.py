@@ -2,66 +2,240 @@
 # vim: noet shiftwidth=4 tabstop=4
 
 from collector import Source, Document
-from subprocess import Popen, PIPE
-from datetime import datetime
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+import os, time, selectors
 
 class Command(Source):
-	def __init__(self, command, arguments=[], bufsize=1048576):
+	def __init__(self, command, arguments=[], bufsize=1048576, timeout=None):
 		Source.__init__(self, "Command")
 		self.command = command
 		self.arguments = arguments
 		self.bufsize = bufsize
+		self.timeout = timeout
 		self.data_stdout = None
 		self.data_stderr = None
 		self.pid = None
+		self.exit_status = None
+		self.duration = None
+		self.timed_out = False
 
 	def execute(self, command, arguments):
+		"""
+		Runs the command and collects stdout and stderr until both are closed
+		or the timeout is reached. A command running into the timeout is
+		killed. Returns (pid, stdout, stderr, exit status, duration, timed out).
+		"""
+		start = time.monotonic()
+		if self.timeout != None:
+			deadline = start+self.timeout
+		else:
+			deadline = None
+
 		p = Popen([command]+arguments, stdout=PIPE, stderr=PIPE)
 
-		data_stdout = b''
-		data_stderr = b''
-		eof_stdout = False
-		eof_stderr = False
+		chunks = { p.stdout: [], p.stderr: [] }
+		timed_out = False
 
-		while True:
-			d = p.stdout.read(self.bufsize)
-			if d == None or len(d) == 0:
-				eof_stdout = True
-			else:
-				data_stdout += d
+		with selectors.DefaultSelector() as sel:
+			sel.register(p.stdout, selectors.EVENT_READ)
+			sel.register(p.stderr, selectors.EVENT_READ)
+
+			while len(sel.get_map()) > 0:
+				if deadline != None:
+					left = deadline-time.monotonic()
+					if left <= 0:
+						timed_out = True
+						break
+				else:
+					left = None
 
-			d = p.stderr.read(self.bufsize)
-			if d == None or len(d) == 0:
-				eof_stderr = True
+				for key, events in sel.select(left):
+					d = os.read(key.fd, self.bufsize)
+					if len(d) == 0:
+						sel.unregister(key.fileobj)
+					else:
+						chunks[key.fileobj] += [d]
+
+		try:
+			if timed_out:
+				raise TimeoutExpired(p.args, self.timeout)
+			elif deadline != None:
+				p.wait(max(deadline-time.monotonic(), 0))
 			else:
-				data_stderr += d
+				p.wait()
+		except TimeoutExpired:
+			timed_out = True
+			p.kill()
+			p.wait()
 
-			if eof_stdout and eof_stderr:
-				break
+		p.stdout.close()
+		p.stderr.close()
 
-		return (p.pid, data_stdout, data_stderr)
+		return (p.pid, b''.join(chunks[p.stdout]), b''.join(chunks[p.stderr]), p.returncode, time.monotonic()-start, timed_out)
 
 	def update(self):
 		Source.update(self)
-		self.pid, self.data_stdout, self.data_stderr = self.execute(self.command, self.arguments)
+		self.pid, self.data_stdout, self.data_stderr, self.exit_status, self.duration, self.timed_out = self.execute(self.command, self.arguments)
 
 	def docs(self):
 		self.update()
-		d = self.get_base_information()
 
 		cmd = self.command
 		for i in self.arguments:
 			cmd += " " + i
 
-		d.update({
+		d = {
 			"name": self.command,
 			self.name: {
 				"command": cmd,
 				"pid": self.pid,
+				"exit_status": self.exit_status,
+				"duration": self.duration,
+				"timed_out": self.timed_out,
 				"stdout": self.data_stdout.decode("UTF-8"),
 				"stderr": self.data_stderr.decode("UTF-8"),
 			},
-		})
+		}
 		
-		return [Document(self.name, doc_type="Command", doc_data=d)]
+		return [Document(self.name, doc_type="Command", doc_data=d, key=self.document_key(cmd), envelope=self.get_base_information())]
+
+
+class StreamingCommand(Command):
+	"""
+	Keeps the command running and emits a document for every record written
+	to stdout, e.g. for vmstat 1 or iostat -x 1. Records are separated by
+	separator, the first skip records after every start are dropped. A dying
+	command is restarted with exponential backoff.
+	"""
+
+	def __init__(self, command, arguments=[], bufsize=1048576, separator=b"\n", skip=0, backoff=1.0, max_backoff=300.0):
+		Command.__init__(self, command, arguments=arguments, bufsize=bufsize)
+		self.name = "StreamingCommand"
+		self.separator = separator
+		self.skip = skip
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.current_backoff = backoff
+		self.process = None
+		self.buffer = b''
+		self.records = []
+		self.sequence = 0
+		self.restarts = 0
+		self.skipped = 0
+		self.started = None
+		self.next_start = 0
+
+	def start(self):
+		self.process = Popen([self.command]+self.arguments, stdout=PIPE, stderr=DEVNULL)
+		os.set_blocking(self.process.stdout.fileno(), False)
+		self.pid = self.process.pid
+		self.buffer = b''
+		self.skipped = 0
+		self.started = time.monotonic()
+
+	def stop(self):
+		if self.process == None:
+			return
+
+		if self.process.poll() == None:
+			self.process.kill()
+
+		self.exit_status = self.process.wait()
+		self.process.stdout.close()
+		self.process = None
+
+	def read(self):
+		"""
+		Reads everything available without blocking. Returns False at the end
+		of the output.
+		"""
+		chunks = [self.buffer]
+
+		try:
+			while True:
+				d = os.read(self.process.stdout.fileno(), self.bufsize)
+				if len(d) == 0:
+					return False
+
+				chunks += [d]
+		except BlockingIOError:
+			return True
+		finally:
+			self.buffer = b''.join(chunks)
+
+	def split_records(self, final=False):
+		parts = self.buffer.split(self.separator)
+		if final:
+			self.buffer = b''
+		else:
+			self.buffer = parts.pop()
+
+		for r in parts:
+			if len(r.strip()) == 0:
+				continue
+
+			if self.skipped < self.skip:
+				self.skipped += 1
+				continue
+
+			self.records += [r.decode("UTF-8", errors="replace")]
+
+	def update(self):
+		Source.update(self)
+		self.records = []
+		now = time.monotonic()
+
+		if self.process == None:
+			if now < self.next_start:
+				return
+
+			try:
+				self.start()
+			except OSError:
+				self.restart_later(now)
+				return
+
+		alive = self.read()
+		self.split_records(final=not alive)
+
+		if not alive:
+			# reset the backoff if the command was running for a while
+			if now-self.started > self.current_backoff:
+				self.current_backoff = self.backoff
+
+			self.stop()
+			self.restart_later(now)
+
+	def restart_later(self, now):
+		self.next_start = now+self.current_backoff
+		self.current_backoff = min(self.current_backoff*2, self.max_backoff)
+		self.restarts += 1
+
+	def docs(self):
+		self.update()
+		envelope = self.get_base_information()
+		docs = []
+
+		cmd = self.command
+		for i in self.arguments:
+			cmd += " " + i
+
+		for record in self.records:
+			self.sequence += 1
+			d = {
+				"name": self.command,
+				self.name: {
+					"command": cmd,
+					"pid": self.pid,
+					"sequence": self.sequence,
+					"restarts": self.restarts,
+					"record": record,
+				},
+			}
+
+			docs += [Document(self.name, doc_type=self.name, doc_data=d, key=self.document_key(cmd, self.sequence), envelope=envelope)]
+
+		return docs
 
+	def close(self):
+		self.stop()
@@ -1,10 +1,122 @@
 # -*- coding: utf-8 -*-
 # vim: noet shiftwidth=4 tabstop=4
 
-import re, os
+import re, os, heapq, threading
 
 REGEX_TIME = re.compile("(([0-9]+)-)?(([0-9]+):)?(([0-9]+):)?([0-9]+)")
 
+class PidIndex:
+	"""
+	Joins processes and cgroups. Cgroup sources publish the pids of their
+	groups every tick, ps sources look up the groups of their processes and
+	publish a short summary per process for the cgroup documents. Without a
+	cgroup source the groups are read from /proc/<pid>/cgroup.
+
+	Every cgroup source publishes under a name of its own, lookups merge the
+	groups of all of them. Sources are collected concurrently, so a ps source
+	may join against the groups published by the previous tick, as may the
+	cgroup documents against the processes.
+	"""
+
+	SUMMARY_FIELDS = ["comm", "user", "pcpu", "rss"]
+
+	def __init__(self, proc="/proc"):
+		self.proc = proc
+		# name of the publishing source -> pid -> { controller: group }
+		self.sources = { }
+		# pid -> { controller: group } read from /proc
+		self.groups = { }
+		self.pending = None
+		self.pending_source = None
+		# set once a cgroup source published its groups
+		self.published = False
+		# pid -> summary of the process
+		self.processes = { }
+		# held by a cgroup source from begin to commit
+		self.lock = threading.Lock()
+
+	def begin(self, source):
+		self.pending = { }
+		self.pending_source = source
+
+	def add(self, controller, group, pids):
+		for pid in pids:
+			if pid not in self.pending:
+				self.pending[pid] = { }
+
+			self.pending[pid][controller] = group
+
+	def commit(self):
+		self.sources[self.pending_source] = self.pending
+		self.pending = None
+		self.pending_source = None
+		self.published = True
+
+	def read_groups(self, pids):
+		"""
+		Reads the groups of the given pids from /proc, used if no cgroup
+		source publishes them.
+		"""
+		groups = { }
+
+		for pid in pids:
+			try:
+				with open("%s/%i/cgroup" % (self.proc, pid), "r") as f:
+					r = { }
+					for line in f:
+						a = line.rstrip("\n").split(":", 2)
+						if len(a) != 3:
+							continue
+
+						if a[1] == "":
+							r["unified"] = a[2]
+						else:
+							for controller in a[1].split(","):
+								r[controller] = a[2]
+
+					groups[pid] = r
+			except OSError:
+				continue
+
+		self.groups = groups
+
+	def lookup(self, pid):
+		if not self.published:
+			return self.groups.get(pid)
+
+		r = None
+		for groups in list(self.sources.values()):
+			g = groups.get(pid)
+			if g == None:
+				continue
+			elif r == None:
+				r = g.copy()
+			else:
+				r.update(g)
+
+		return r
+
+	def set_processes(self, pids):
+		"""
+		Takes the process table of a ps source, keyed by pid strings.
+		"""
+		processes = { }
+
+		for pid in pids:
+			data = pids[pid]
+			summary = { "pid": int(pid) }
+			for field in PidIndex.SUMMARY_FIELDS:
+				if field in data:
+					summary[field] = data[field]
+
+			processes[int(pid)] = summary
+
+		self.processes = processes
+
+	def top_processes(self, pids, n=3, key="pcpu"):
+		r = [self.processes[pid] for pid in pids if pid in self.processes]
+		return heapq.nlargest(n, r, key=lambda p: p.get(key, 0))
+
 def compute_difference_over_dictonaries(new, old, diffseconds = 0):
 	r = { }
 
@@ -43,6 +155,26 @@ def compute_difference_over_dictonaries(new, old, diffseconds = 0):
 
 	return r
 
+def sum_over_dictonaries(total, new):
+	"""
+	Adds all numeric values of new to total, nested dictonaries are summed up
+	recursively. Other values are ignored.
+	"""
+	for k in new:
+		if type(new[k]) == dict:
+			if k not in total or type(total[k]) != dict:
+				total[k] = { }
+
+			sum_over_dictonaries(total[k], new[k])
+
+		elif type(new[k]) == float or type(new[k]) == int:
+			if k in total and (type(total[k]) == float or type(total[k]) == int):
+				total[k] += new[k]
+			else:
+				total[k] = new[k]
+
+	return total
+
 def field_converter_integer(value):
 	try:
 		v = int(value)
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 noet
 
-from datetime import datetime
-import os, socket, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import os, threading, time
 from collector import Source, Document
-from collector.sources import compute_difference_over_dictonaries, field_converter_integer, field_converter_kilobyte, field_converter_nanosecond, field_converter_microsecond, field_converter_millisecond, field_converter_userhz
+from collector.sources.cgroup.discovery import create_discovery
+from collector.sources.delta import delta_engine
+from collector.sources import compute_difference_over_dictonaries, sum_over_dictonaries, field_converter_integer, field_converter_nanosecond, field_converter_microsecond, field_converter_millisecond, field_converter_userhz
 
 class GroupException(Exception):
 	def __init__(self, cause, data=None):
@@ -32,13 +34,26 @@ class GroupExceptionInaccessiblePath(GroupException):
 		GroupException.__init__(self, "Path not accessible", path)
 
 class CGroup(Source):
+	BUFFER_SIZE = 4096
+	# parameters only counting the group itself, summed up for rollups
+	ROLLUP_PARAMS = []
+
 	def __init__(self, name, gtype, path, source="Filesystem"):
 		Source.__init__(self, name)
 		self.type = gtype
 		self.path = os.path.abspath(path)
 		self.data = { }
-		self.last_data = { }
+		# DeltaState of the current and the previous update
+		self.state = None
+		self.last_state = None
 		self.pids = { }
+		# parameter name -> file descriptor, None for non existing files
+		self.files = { }
+		self.buffer = bytearray(CGroup.BUFFER_SIZE)
+		# file content read during the current update
+		self.raw = { }
+		# shared PidIndex, if processes are joined with groups
+		self.pid_index = None
 		self.params = [
 			# name, filename, read function, simple value monotonic growing
 			("tasks", "tasks", self.read_param_array, field_converter_integer),
@@ -47,28 +62,66 @@ class CGroup(Source):
 	def update(self):
 		Source.update(self)
 
-		self.last_data = self.data
 		self.data = { }
+		self.raw = { }
+		# several parameters may point to the same file, read and parse it once
+		parsed = { }
 
 		for param, filename, func, conv in self.params:
+			key = (filename, func, conv)
+			if key in parsed:
+				d = parsed[key]
+			else:
+				d = func(filename, conv)
+				parsed[key] = d
+
 			if param == "tasks":
-				self.pids = func(filename)
+				self.pids = d
 
-			d = func(filename, conv)
 			if d != None and (type(d) in [int, float] or len(d) > 0):
 				self.data[param] = d
 
+		self.update_state()
+
+	def update_state(self):
+		self.last_state = self.state
+		self.state = delta_engine.snapshot(self.data)
+
 	def build_data(self, timediff_sec):
-		return [compute_difference_over_dictonaries(self.data, self.last_data, timediff_sec)]
+		return [delta_engine.difference(self.state, self.last_state, timediff_sec)]
+
+	def data_key(self, data):
+		"""
+		Identifies an item of build_data within the group.
+		"""
+		return ()
+
+	def rollup_data(self):
+		r = { "tasks": len(self.pids) }
+
+		for param in self.ROLLUP_PARAMS:
+			if param in self.data:
+				r[param] = self.data[param]
+
+		return r
+
+	def docs(self, envelope=None):
+		"""
+		Documents of the group, envelope is shared with the documents of other
+		groups if given.
+		"""
+		if envelope == None:
+			envelope = self.get_base_information()
 
-	def docs(self):
 		docs = [ ]
-		basedoc = self.get_base_information()
-		basedoc.update({
+		basedoc = {
 			"name": self.name,
 			"path": self.path,
 			"pids": self.pids,
-		})
+		}
+
+		if self.pid_index != None and len(self.pid_index.processes) > 0:
+			basedoc["top_processes"] = self.pid_index.top_processes(self.pids)
 
 		for d in self.build_data(self.get_timedelta()):
 			doc_data = basedoc.copy()
@@ -77,7 +130,9 @@ class CGroup(Source):
 			docs += [Document(
 				self.name,
 				doc_type = self.type,
-				doc_data = doc_data
+				doc_data = doc_data,
+				key = self.document_key(self.path, *self.data_key(d)),
+				envelope = envelope
 			)]
 
 		return docs 
@@ -93,32 +148,71 @@ class CGroup(Source):
 		if param.find("/") >= 0:
 			raise GroupExceptionBadPath(param)
 
-	def read_param(self, param, conv=None):
-		self.test_param(param)
+	def open_param(self, param):
+		if param in self.files:
+			return self.files[param]
 
 		p = self.path + "/" + param
-		if os.path.exists(p) == False:
-			return None
-
-		f = open(p, "r")
-		if f == None:
+		try:
+			fd = os.open(p, os.O_RDONLY | os.O_CLOEXEC)
+		except FileNotFoundError:
+			fd = None
+		except OSError:
 			raise GroupExceptionInaccessiblePath(p)
+
+		self.files[param] = fd
+		return fd
+
+	def close_param(self, param):
+		fd = self.files.pop(param, None)
+		if fd != None:
+			os.close(fd)
+
+	def close(self):
+		for param in list(self.files):
+			self.close_param(param)
+
+	def read_param(self, param, conv=None):
+		self.test_param(param)
+
+		if param in self.raw:
+			d = self.raw[param]
 		else:
-			# TODO: customize
-			d = f.read(1024)
-			f.close()
+			d = self.read_file(param)
+			self.raw[param] = d
 
 		if d == None:
 			return None
 
-		if len(d) == 0:
-			return None
-
 		if conv != None:
 			return conv(d)
 		else:
 			return d
 
+	def read_file(self, param):
+		fd = self.open_param(param)
+		if fd == None:
+			return None
+
+		while True:
+			try:
+				n = os.preadv(fd, [self.buffer], 0)
+			except OSError:
+				# group was removed while the file was open
+				self.close_param(param)
+				return None
+
+			if n < len(self.buffer):
+				break
+
+			# file may be truncated, retry with a bigger buffer
+			self.buffer = bytearray(len(self.buffer)*2)
+
+		if n == 0:
+			return None
+
+		return self.buffer[:n].decode("UTF-8")
+
 	def read_param_key_value(self, param, conv=None):
 		r = {}
 
@@ -203,6 +297,8 @@ class CPU(CGroup):
 		]
 
 class Memory(CGroup):
+	ROLLUP_PARAMS = ["stat"]
+
 	def __init__(self, name, path):
 		CGroup.__init__(self, name, self.__class__.__name__, path)
 		self.params += [
@@ -218,8 +314,87 @@ class Memory(CGroup):
 				("stat", "memory.stat", self.read_param_key_value, field_converter_integer),
 		]
 
+	def rollup_data(self):
+		r = CGroup.rollup_data(self)
+
+		# total_* and hierarchical_* values already include the sub groups
+		if "stat" in r:
+			r["stat"] = dict([(k, v) for k, v in r["stat"].items() if not k.startswith("total_") and not k.startswith("hierarchical_")])
+
+		return r
+
+class BlockDevices:
+	"""
+	Resolves "major:minor" numbers into device names with the uevent files of
+	/sys/dev/block. The table is loaded once, a device not in it is read on
+	its own. Unknown devices are looked up again after UNKNOWN_TTL seconds.
+	"""
+
+	UNKNOWN_TTL = 60.0
+
+	def __init__(self, path="/sys/dev/block"):
+		self.path = path
+		self.loaded = False
+		self.names = { }
+		# majmin -> monotonic time it is looked up again
+		self.unknown = { }
+		self.lock = threading.Lock()
+
+	def read_name(self, majmin):
+		try:
+			with open("%s/%s/uevent" % (self.path, majmin), "r") as f:
+				for line in f:
+					if line.startswith("DEVNAME="):
+						return line[8:].strip()
+		except OSError:
+			None
+
+		return None
+
+	def load(self):
+		try:
+			entries = os.listdir(self.path)
+		except OSError:
+			return
+
+		for majmin in entries:
+			n = self.read_name(majmin)
+			if n != None:
+				self.names[majmin] = n
+
+	def name(self, majmin):
+		n = self.names.get(majmin)
+		if n != None:
+			return n
+
+		with self.lock:
+			if not self.loaded:
+				self.loaded = True
+				self.load()
+				n = self.names.get(majmin)
+				if n != None:
+					return n
+
+			now = time.monotonic()
+			if self.unknown.get(majmin, 0) > now:
+				return majmin
+
+			n = self.read_name(majmin)
+			if n == None:
+				self.unknown[majmin] = now+BlockDevices.UNKNOWN_TTL
+				return majmin
+
+			self.unknown.pop(majmin, None)
+			self.names[majmin] = n
+
+		return n
+
+block_devices = BlockDevices()
+
 class Blkio(CGroup):
-	def __init__(self, name, path):
+	ROLLUP_PARAMS = ["io_serviced", "io_service_bytes", "io_service_time", "io_merged", "io_wait_time", "io_queued", "time"]
+
+	def __init__(self, name, path, recursive=True):
 		CGroup.__init__(self, name, self.__class__.__name__, path)
 		self.params += [
 				("io_serviced", "blkio.io_service_bytes", self.read_per_device_key_value, field_converter_integer),
@@ -238,43 +413,41 @@ class Blkio(CGroup):
 				("time_recursive", "blkio.time_recursive", self.read_per_device_value, field_converter_millisecond),
 		]
 
-	def build_data(self, timediff_sec):
-		r_old = { }
-		g_old = { }
-		r_new = { }
-		g_new = { }
-		r = { }
-
-		for key in self.last_data:
-			if key[:3] == "io_" or key[:4] == "time":
-				for dev in self.last_data[key]:
-					if dev not in r_old:
-						r_old[dev] = { "device": dev }
+		if not recursive:
+			self.params = [p for p in self.params if not p[0].endswith("_recursive")]
 
-					r_old[dev][key] = self.last_data[key][dev]
-			else:
-				g_old[key] = self.last_data[key]
+	def update_state(self):
+		# one DeltaState per device, parameters not per device are added to each
+		devices = { }
+		common = { }
 
 		for key in self.data:
 			if key[:3] == "io_" or key[:4] == "time":
 				for dev in self.data[key]:
-					if dev not in r_new:
-						r_new[dev] = { "device": dev }
+					if dev not in devices:
+						devices[dev] = { "device": dev }
 
-					r_new[dev][key] = self.data[key][dev]
+					devices[dev][key] = self.data[key][dev]
 			else:
-				g_new[key] = self.data[key]
+				common[key] = self.data[key]
 
-		for dev in r_new:
-			r_new[dev].update(g_new)
+		self.last_state = self.state
+		self.state = { }
+		for dev in devices:
+			devices[dev].update(common)
+			self.state[dev] = delta_engine.snapshot(devices[dev])
 
-			if dev in r_old:
-				r_old[dev].update(g_old)
-				r[dev] = compute_difference_over_dictonaries(r_new[dev], r_old[dev], timediff_sec)
-			else:
-				r[dev] = compute_difference_over_dictonaries(r_new[dev], { }, timediff_sec)
+	def build_data(self, timediff_sec):
+		r = [ ]
+		last_state = self.last_state or { }
+
+		for dev in self.state:
+			r += [delta_engine.difference(self.state[dev], last_state.get(dev), timediff_sec)]
+
+		return r
 
-		return r.values()
+	def data_key(self, data):
+		return (data["device"],)
 
 	def read_per_device_value(self, param, conv=None):
 		r = { }
@@ -301,7 +474,8 @@ class Blkio(CGroup):
 
 		d = self.read_param(param)
 		if d == None:
-			raise Exception("parameter %s returns null!" % (param))
+			# not supported by the kernel or the group was just removed
+			return r
 
 		d = d.split("\n")
 
@@ -322,86 +496,194 @@ class Blkio(CGroup):
 		return r
 
 	def get_devname_from_major_minor(self, majmin):
-		v = majmin.split(":")
-		major = int(v[0])
-		minor = int(v[1])
+		return block_devices.name(majmin)
+
+class CGroupFilesystem(Source):
+	def __init__(self, mount_point, controller=["blkio", "cpuacct", "memory"], discovery="walk", workers=1, rollup=False):
+		Source.__init__(self, "CGroupFilesystem")
+		self.mount_point = mount_point
+		self.controller = controller
+		self.discovery_mode = discovery
+		self.discovery = { }
+		self.groups = { }
+		self.workers = workers
+		self.executor = None
+		self.rollup = rollup
+		self.rollups = { }
+		self.last_rollups = { }
+		# shared PidIndex the pids of all groups are published to
+		self.pid_index = None
 
-		if major == 8:
-			disk = int(minor / 8)
-			disk = chr(ord('a')+disk)
-			part = (minor % 8)+1
+	def controller_path(self, controller):
+		return "%s/%s" % (self.mount_point, controller)
 
-			return "sd%s%i" % (disk, part)
+	def enumerate_groups(self, controller):
+		if controller not in self.discovery:
+			self.discovery[controller] = create_discovery(self.discovery_mode, self.controller_path(controller))
+
+		return [(cg, dirname, controller) for cg, dirname in self.discovery[controller].groups()]
 
-		elif major == 112:
-			disk = int(minor / 8)
-			disk = chr(ord('a')+disk)
-			part = (minor % 8)+1
+	def create_group(self, controller, name, path):
+		if controller == "cpu":
+			return CPU(name, path)
 
-			return "sd%s%i" % (disk, part)
+		elif controller == "cpuacct":
+			return CPUAccount(name, path)
 
-		elif major == 252:
-			return "dm-%i" % (int(minor))
+		elif controller == "memory":
+			return Memory(name, path)
+
+		elif controller == "blkio":
+			# rollups replace the recursive files of the kernel
+			return Blkio(name, path, recursive=not self.rollup)
 
 		else:
-			return majmin
+			return None
 
-class CGroupFilesystem(Source):
-	def __init__(self, mount_point, controller=["blkio", "cpuacct", "memory"]):
-		Source.__init__(self, "CGroupFilesystem")
-		self.mount_point = mount_point
-		self.controller = controller
-		self.groups = { }
+	def map(self, func, items):
+		"""
+		Applies func on every item, in parallel if more than one worker is
+		configured. Results are returned in the order of the items.
+		"""
+		if self.workers <= 1:
+			return [func(i) for i in items]
 
-	def enumerate_groups(self, controller):
-		r = []
+		if self.executor == None:
+			self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+		return list(self.executor.map(func, items))
 
-		search_path = "%s/%s" % (self.mount_point, controller)
-		for dirname, directories, files in os.walk(search_path):
-			cg = dirname[len(search_path):]
-			if cg == "":
-				cg = "/"
+	def all_groups(self):
+		r = []
 
-			r += [(cg, dirname, controller)]
+		for controller in self.groups:
+			r += self.groups[controller].values()
 
 		return r
 
 	def update(self):
-		cgs = []
+		Source.update(self)
 
 		for controller in self.controller:
-			cgs += self.enumerate_groups(controller)
 			if not controller in self.groups:
 				self.groups[controller] = { }
 
-		for name, path, controller in cgs:
-			if not name in self.groups[controller]:
-				if controller == "cpu":
-					self.groups[controller][name] = CPU(name, path)
+			groups = self.groups[controller]
+			found = set()
 
-				elif controller == "cpuacct":
-					self.groups[controller][name] = CPUAccount(name, path)
+			for name, path, controller in self.enumerate_groups(controller):
+				if not name in groups:
+					g = self.create_group(controller, name, path)
+					if g == None:
+						continue
 
-				elif controller == "memory":
-					self.groups[controller][name] = Memory(name, path)
-				
-				elif controller == "blkio":
-					self.groups[controller][name] = Blkio(name, path)
+					g.pid_index = self.pid_index
+					groups[name] = g
 
-				else:
-					continue
+				found.add(name)
+
+			# evict groups whose directory was removed
+			for name in [name for name in groups if name not in found]:
+				groups.pop(name).close()
+
+		self.map(lambda g: g.update(), self.all_groups())
+
+		if self.pid_index != None:
+			with self.pid_index.lock:
+				self.pid_index.begin("%s:%s" % (self.name, self.mount_point))
+				for controller in self.groups:
+					for name in self.groups[controller]:
+						self.pid_index.add(controller, name, self.groups[controller][name].pids)
 
-			self.groups[controller][name].update()
+				self.pid_index.commit()
+
+		if self.rollup:
+			self.last_rollups = self.rollups
+			self.rollups = { }
+			for controller in self.groups:
+				self.rollups[controller] = self.compute_rollups(self.groups[controller])
+
+	def compute_rollups(self, groups):
+		"""
+		Sums up the rollup data of every group and its descendants in a single
+		post-order pass. Returns a dictonary of group name to totals, only for
+		groups having sub groups.
+		"""
+		children = { }
+		for name in groups:
+			if name != "/":
+				children.setdefault(os.path.dirname(name), []).append(name)
+
+		totals = { }
+		r = { }
+		if "/" not in groups:
+			return r
+
+		stack = [("/", False)]
+		while len(stack) > 0:
+			name, visited = stack.pop()
+			if not visited:
+				stack.append((name, True))
+				for c in children.get(name, []):
+					stack.append((c, False))
+				continue
+
+			t = sum_over_dictonaries({ }, groups[name].rollup_data())
+			t["groups"] = 1
+			for c in children.get(name, []):
+				sum_over_dictonaries(t, totals[c])
+
+			totals[name] = t
+			if name in children:
+				r[name] = t
+
+		return r
+
+	def rollup_docs(self, envelope):
+		docs = []
+
+		for controller in self.rollups:
+			last = self.last_rollups.get(controller, { })
+
+			for name in self.rollups[controller]:
+				g = self.groups[controller][name]
+				doc_type = g.type + "Rollup"
+				doc_data = {
+					"name": name,
+					"path": g.path,
+					doc_type: compute_difference_over_dictonaries(self.rollups[controller][name], last.get(name, { }), self.get_timedelta()),
+				}
+
+				docs += [Document(self.name, doc_type=doc_type, doc_data=doc_data, key=self.document_key(name), envelope=envelope)]
+
+		return docs
 
 	def docs(self):
 		self.update()
 
+		# one envelope for all groups of this collection
+		envelope = self.get_base_information()
+
 		docs = []
-		for controller in self.groups:
-			for name in self.groups[controller]:
-				docs += self.groups[controller][name].docs()
+		for d in self.map(lambda g: g.docs(envelope), self.all_groups()):
+			docs += d
+
+		if self.rollup:
+			docs += self.rollup_docs(envelope)
 
 		return docs
 
+	def close(self):
+		if self.executor != None:
+			self.executor.shutdown()
+			self.executor = None
 
+		for controller in self.groups:
+			for name in self.groups[controller]:
+				self.groups[controller][name].close()
+
+		for controller in self.discovery:
+			self.discovery[controller].close()
 
+		self.groups = { }
+		self.discovery = { }
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 noet
+
+import os, struct, ctypes, ctypes.util
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify:
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		if not hasattr(libc, "inotify_init1"):
+			raise OSError("inotify not supported")
+
+		self.libc = libc
+		self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+
+	def add_watch(self, path, mask):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e), path)
+
+		return wd
+
+	def rm_watch(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def read(self):
+		r = []
+
+		while True:
+			try:
+				buf = os.read(self.fd, 65536)
+			except BlockingIOError:
+				break
+
+			offset = 0
+			while offset < len(buf):
+				wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+				offset += INOTIFY_EVENT.size
+				name = buf[offset:offset+length].rstrip(b"\0")
+				offset += length
+				r += [(wd, mask, os.fsdecode(name))]
+
+		return r
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+class Discovery:
+	"""
+	Finds the group directories below the root of a controller hierarchy.
+	"""
+
+	def __init__(self, root):
+		self.root = root
+
+	def name(self, dirname):
+		cg = dirname[len(self.root):]
+		if cg == "":
+			cg = "/"
+
+		return cg
+
+	def groups(self):
+		"""
+		Returns a list of (group name, directory) tuples.
+		"""
+		return []
+
+	def close(self):
+		None
+
+class WalkDiscovery(Discovery):
+	"""
+	Walks the whole hierarchy on every call.
+	"""
+
+	def groups(self):
+		r = []
+
+		for dirname, directories, files in os.walk(self.root):
+			r += [(self.name(dirname), dirname)]
+
+		return r
+
+class InotifyDiscovery(Discovery):
+	"""
+	Keeps the tree in memory and watches every directory with inotify for
+	created and removed groups. Falls back to WalkDiscovery if watches run
+	out.
+	"""
+
+	MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+	def __init__(self, root):
+		Discovery.__init__(self, root)
+		self.inotify = Inotify()
+		self.fallback = None
+		# directory -> watch descriptor and vice versa
+		self.dirs = { }
+		self.watches = { }
+
+		try:
+			self.add(root)
+		except OSError:
+			self.inotify.close()
+			raise
+
+	def add(self, dirname):
+		# watch before listing, so no group created in between is missed
+		try:
+			wd = self.inotify.add_watch(dirname, InotifyDiscovery.MASK)
+		except FileNotFoundError:
+			return
+
+		self.dirs[dirname] = wd
+		self.watches[wd] = dirname
+
+		try:
+			entries = [e.path for e in os.scandir(dirname) if e.is_dir(follow_symlinks=False)]
+		except FileNotFoundError:
+			self.remove(dirname)
+			return
+
+		for i in entries:
+			if i not in self.dirs:
+				self.add(i)
+
+	def remove(self, dirname):
+		prefix = dirname + "/"
+
+		for d in [d for d in self.dirs if d == dirname or d.startswith(prefix)]:
+			wd = self.dirs.pop(d)
+			if self.watches.get(wd) == d:
+				del self.watches[wd]
+				self.inotify.rm_watch(wd)
+
+	def resync(self):
+		for wd in self.watches:
+			self.inotify.rm_watch(wd)
+
+		self.dirs = { }
+		self.watches = { }
+		self.add(self.root)
+
+	def handle_events(self):
+		for wd, mask, name in self.inotify.read():
+			if mask & IN_Q_OVERFLOW:
+				self.resync()
+				continue
+
+			if mask & IN_IGNORED:
+				dirname = self.watches.pop(wd, None)
+				if dirname != None and self.dirs.get(dirname) == wd:
+					self.remove(dirname)
+				continue
+
+			if not mask & IN_ISDIR or wd not in self.watches:
+				continue
+
+			dirname = os.path.join(self.watches[wd], name)
+			if mask & (IN_CREATE | IN_MOVED_TO):
+				self.add(dirname)
+			elif mask & (IN_DELETE | IN_MOVED_FROM):
+				self.remove(dirname)
+
+	def groups(self):
+		if self.fallback != None:
+			return self.fallback.groups()
+
+		try:
+			if self.root not in self.dirs:
+				self.add(self.root)
+
+			self.handle_events()
+		except OSError:
+			# e.g. out of watches, continue without inotify
+			self.close()
+			self.fallback = WalkDiscovery(self.root)
+			return self.fallback.groups()
+
+		return [(self.name(d), d) for d in self.dirs]
+
+	def close(self):
+		self.inotify.close()
+		self.dirs = { }
+		self.watches = { }
+
+def create_discovery(mode, root):
+	if mode == "inotify":
+		try:
+			return InotifyDiscovery(root)
+		except OSError:
+			return WalkDiscovery(root)
+
+	elif mode == "walk":
+		return WalkDiscovery(root)
+
+	else:
+		raise ValueError("unknown discovery mode %s" % (mode))
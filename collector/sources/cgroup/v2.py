@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 noet
+
+from collector.sources.cgroup import CGroup, CGroupFilesystem, block_devices
+from collector.sources import field_converter_integer, field_converter_float, field_converter_microsecond
+
+class UnifiedGroup(CGroup):
+	"""
+	A group of the cgroup v2 hierarchy. All controllers live in the same
+	directory and most counters are grouped as keys of a few files.
+	"""
+
+	def __init__(self, name, path):
+		CGroup.__init__(self, name, "CGroupV2", path)
+		self.params = [
+			("tasks", "cgroup.procs", self.read_param_array, field_converter_integer),
+			("cpu_stat", "cpu.stat", self.read_param_usec_key_value, field_converter_integer),
+			("memory_current", "memory.current", self.read_param, field_converter_integer),
+			("memory_stat", "memory.stat", self.read_param_key_value, field_converter_integer),
+			("io_stat", "io.stat", self.read_param_io_stat, field_converter_integer),
+			("cpu_pressure", "cpu.pressure", self.read_param_pressure, field_converter_float),
+			("memory_pressure", "memory.pressure", self.read_param_pressure, field_converter_float),
+			("io_pressure", "io.pressure", self.read_param_pressure, field_converter_float),
+		]
+
+	def read_param_usec_key_value(self, param, conv=None):
+		"""
+		Reads a flat keyed file like cpu.stat, keys ending with _usec are
+		converted into seconds.
+		"""
+		r = self.read_param_key_value(param)
+
+		for k in r:
+			if k.endswith("_usec"):
+				r[k] = field_converter_microsecond(r[k])
+			elif conv != None:
+				r[k] = conv(r[k])
+
+		return r
+
+	def read_param_io_stat(self, param, conv=None):
+		"""
+		Reads lines of "MAJ:MIN key=value ..." into a dictonary per device.
+		"""
+		r = { }
+
+		d = self.read_param(param)
+		if d == None:
+			return r
+
+		for i in d.split("\n"):
+			j = i.split(" ")
+			if len(j) < 2:
+				continue
+
+			dev = block_devices.name(j[0])
+			r[dev] = { }
+			for k in j[1:]:
+				kv = k.split("=", 1)
+				if len(kv) != 2:
+					continue
+
+				if conv != None:
+					r[dev][kv[0]] = conv(kv[1])
+				else:
+					r[dev][kv[0]] = kv[1]
+
+		return r
+
+	def read_param_pressure(self, param, conv=None):
+		"""
+		Reads pressure stall information, lines of "some|full avg10=... total=...".
+		The total stall time is converted into seconds.
+		"""
+		r = { }
+
+		d = self.read_param(param)
+		if d == None:
+			return r
+
+		for i in d.split("\n"):
+			j = i.split(" ")
+			if len(j) < 2:
+				continue
+
+			r[j[0]] = { }
+			for k in j[1:]:
+				kv = k.split("=", 1)
+				if len(kv) != 2:
+					continue
+
+				if kv[0] == "total":
+					r[j[0]][kv[0]] = field_converter_microsecond(kv[1])
+				elif conv != None:
+					r[j[0]][kv[0]] = conv(kv[1])
+				else:
+					r[j[0]][kv[0]] = kv[1]
+
+		return r
+
+class CGroupV2(CGroupFilesystem):
+	"""
+	Collects the unified hierarchy, every group is read in a single pass over
+	its directory.
+	"""
+
+	def __init__(self, mount_point, discovery="walk", workers=1, rollup=False):
+		CGroupFilesystem.__init__(self, mount_point, controller=["unified"], discovery=discovery, workers=workers, rollup=rollup)
+		self.name = "CGroupV2"
+
+	def controller_path(self, controller):
+		return self.mount_point
+
+	def create_group(self, controller, name, path):
+		return UnifiedGroup(name, path)
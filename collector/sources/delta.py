@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+
+from operator import itemgetter
+
+# kinds of values
+DICT = 0
+NUMBER = 1
+LIST = 2
+VALUE = 3
+
+def kind_of(t):
+	if t == dict:
+		return DICT
+	elif t == int or t == float:
+		return NUMBER
+	elif t == list:
+		return LIST
+	else:
+		return VALUE
+
+def signature(data):
+	"""
+	Key layout of a nested dictonary, the keys and value types of each level.
+	"""
+	values = data.values()
+	types = tuple(map(type, values))
+
+	if dict in types:
+		return (tuple(data), types, tuple([signature(v) for v in values if type(v) == dict]))
+	else:
+		return (tuple(data), types, None)
+
+def getter(slots):
+	if len(slots) == 0:
+		return lambda values: ()
+	elif len(slots) == 1:
+		slot = slots[0]
+		return lambda values: (values[slot],)
+	else:
+		return itemgetter(*slots)
+
+def list_difference(items, old):
+	if items == old:
+		return { "items": items, "removed": [], "added": [] }
+
+	return {
+		"items": items,
+		"removed": list(set(items).difference(set(old))),
+		"added": list(set(old).difference(set(items))),
+	}
+
+class DeltaLayout:
+	"""
+	Key layout of a nested dictonary compiled into flat slots. The values of
+	a dictonary are kept as one tuple, numbers and lists are additionally
+	picked into tuples of their own. The differences are computed while
+	expanding the slots back into a nested dictonary, by functions generated
+	for the layout.
+	"""
+
+	def __init__(self, sig):
+		# (depth, key, kind, slot, number or list index)
+		self.ops = []
+		# path -> op, to align with values of another layout
+		self.paths = { }
+		self.depth = 0
+		self.flat = sig[2] == None
+		# keys not written as literals into generated code
+		self.keys = []
+		# path of each slot
+		self.slots = []
+
+		self.number_slots = []
+		self.list_slots = []
+		self.compile(sig, 0, ())
+
+		self.numbers = getter(self.number_slots)
+		self.lists = getter(self.list_slots)
+
+		if self.flat:
+			self.extract = None
+		else:
+			self.extract = self.generate("d", "(%s)" % ("".join([self.access(p) + ", " for p in self.slots])))
+
+		# absolute values only, with differences and with differences per second
+		self.expand = [self.generate("v, o, l, t", self.source(mode, 0, 0)[0]) for mode in range(0, 3)]
+
+	def compile(self, sig, depth, path):
+		keys, types, children = sig
+		child = 0
+		self.depth = max(self.depth, depth+1)
+
+		for i in range(0, len(keys)):
+			kind = kind_of(types[i])
+			key = keys[i]
+			p = path + (key,)
+
+			if kind == DICT:
+				op = (depth, key, kind, None, None)
+				self.ops += [op]
+				self.paths[p] = op
+				self.compile(children[child], depth+1, p)
+				child += 1
+				continue
+
+			slot = len(self.slots)
+			self.slots += [p]
+			if kind == NUMBER:
+				op = (depth, key, kind, slot, len(self.number_slots))
+				self.number_slots += [slot]
+			elif kind == LIST:
+				op = (depth, key, kind, slot, len(self.list_slots))
+				self.list_slots += [slot]
+			else:
+				op = (depth, key, kind, slot, None)
+
+			self.ops += [op]
+			self.paths[p] = op
+
+	def constant(self, key):
+		if type(key) == str or type(key) == int:
+			return repr(key)
+
+		self.keys += [key]
+		return "K[%i]" % (len(self.keys)-1)
+
+	def access(self, path):
+		# path as subscripts of the dictonary d
+		return "d" + "".join(["[%s]" % (self.constant(k)) for k in path])
+
+	def source(self, mode, start, depth):
+		"""
+		Source of a dictonary display for the ops of one level from start,
+		returns it and the position of the first op not on this level.
+		"""
+		items = []
+		i = start
+
+		while i < len(self.ops) and self.ops[i][0] == depth:
+			d, key, kind, slot, index = self.ops[i]
+			key = self.constant(key)
+
+			if kind == DICT:
+				s, i = self.source(mode, i+1, depth+1)
+				items += ["%s: %s" % (key, s)]
+				continue
+
+			if kind == NUMBER:
+				if mode == 0:
+					v = "{ 'absolute': v[%i] }" % (slot)
+				elif mode == 1:
+					v = "{ 'absolute': v[%i], 'difference': v[%i]-o[%i] }" % (slot, slot, index)
+				else:
+					v = "{ 'absolute': v[%i], 'difference': (x := v[%i]-o[%i]), 'difference_per_second': x/t }" % (slot, slot, index)
+			elif kind == LIST:
+				if mode == 0:
+					v = "{ 'items': v[%i] }" % (slot)
+				else:
+					v = "list_difference(v[%i], l[%i])" % (slot, index)
+			else:
+				v = "v[%i]" % (slot)
+
+			items += ["%s: %s" % (key, v)]
+			i += 1
+
+		return ("{ %s }" % (", ".join(items)), i)
+
+	def generate(self, arguments, expression):
+		scope = { "K": tuple(self.keys), "list_difference": list_difference }
+		exec("def f(%s):\n\treturn %s\n" % (arguments, expression), scope)
+		return scope["f"]
+
+class DeltaState:
+	"""
+	Values of a nested dictonary in the slots of its layout. Top level numbers
+	can be looked up by key.
+	"""
+
+	__slots__ = ("layout", "values", "numbers", "lists")
+
+	def __init__(self, layout, values, numbers, lists):
+		self.layout = layout
+		self.values = values
+		self.numbers = numbers
+		self.lists = lists
+
+	def lookup(self, path, kind=NUMBER):
+		op = self.layout.paths.get(path)
+		if op == None or op[2] != kind:
+			return None
+		elif kind == NUMBER:
+			return self.numbers[op[4]]
+		else:
+			return self.lists[op[4]]
+
+	def __contains__(self, key):
+		return self.lookup((key,)) != None
+
+	def __getitem__(self, key):
+		return self.lookup((key,))
+
+	def get(self, key, default=None):
+		v = self.lookup((key,))
+		if v == None:
+			return default
+		else:
+			return v
+
+class DeltaEngine:
+	"""
+	Computes absolute values, differences and differences per second of
+	nested dictonaries, with the same results as
+	compute_difference_over_dictonaries. The key layout is compiled once, the
+	differences of all numbers and the nested result are computed in a single
+	call of a function generated for the layout.
+	"""
+
+	MAX_LAYOUTS = 4096
+
+	def __init__(self):
+		self.layouts = { }
+
+	def compile(self, sig):
+		if len(self.layouts) >= DeltaEngine.MAX_LAYOUTS:
+			self.layouts = { }
+
+		layout = DeltaLayout(sig)
+		self.layouts[sig] = layout
+		return layout
+
+	def snapshot(self, data):
+		"""
+		Returns the DeltaState of a nested dictonary.
+		"""
+		sig = signature(data)
+		layout = self.layouts.get(sig)
+		if layout == None:
+			layout = self.compile(sig)
+
+		if layout.extract == None:
+			values = tuple(data.values())
+		else:
+			values = layout.extract(data)
+
+		return DeltaState(layout, values, layout.numbers(values), layout.lists(values))
+
+	def align(self, new, old):
+		"""
+		Differences against a state of another layout, matched by path.
+		"""
+		diffs = [None]*len(new.numbers)
+		lists = [None]*len(new.lists)
+
+		for path in new.layout.paths:
+			op = new.layout.paths[path]
+
+			if op[2] == NUMBER:
+				o = old.lookup(path, NUMBER)
+				if o != None:
+					diffs[op[4]] = new.numbers[op[4]]-o
+			elif op[2] == LIST:
+				lists[op[4]] = old.lookup(path, LIST)
+
+		return (diffs, lists)
+
+	def expand(self, new, diffs, lists, diffseconds):
+		"""
+		Builds the nested dictonary from differences that may be missing.
+		"""
+		values = new.values
+		r = { }
+		stack = [r]*(new.layout.depth+1)
+
+		for depth, key, kind, slot, index in new.layout.ops:
+			parent = stack[depth]
+
+			if kind == DICT:
+				c = { }
+				parent[key] = c
+				stack[depth+1] = c
+
+			elif kind == NUMBER:
+				v = { "absolute": values[slot] }
+
+				if diffs[index] != None:
+					v["difference"] = diffs[index]
+					if diffseconds != 0:
+						v["difference_per_second"] = diffs[index]/diffseconds
+
+				parent[key] = v
+
+			elif kind == LIST:
+				if lists[index] != None:
+					parent[key] = list_difference(values[slot], lists[index])
+				else:
+					parent[key] = { "items": values[slot] }
+
+			else:
+				parent[key] = values[slot]
+
+		return r
+
+	def difference(self, new, old, diffseconds=0):
+		"""
+		Expands the DeltaState new into a nested dictonary with the
+		differences against the state old, which may be None. Only the
+		numbers and lists of old are needed.
+		"""
+		layout = new.layout
+
+		if old == None:
+			return layout.expand[0](new.values, None, None, diffseconds)
+
+		elif old.layout is layout:
+			if diffseconds == 0:
+				return layout.expand[1](new.values, old.numbers, old.lists, diffseconds)
+			else:
+				return layout.expand[2](new.values, old.numbers, old.lists, diffseconds)
+
+		else:
+			diffs, lists = self.align(new, old)
+			return self.expand(new, diffs, lists, diffseconds)
+
+	def compute(self, data, old, diffseconds=0):
+		"""
+		Returns the expanded differences of data against the state old and the
+		state of data for the next call.
+		"""
+		new = self.snapshot(data)
+		return (self.difference(new, old, diffseconds), new)
+
+delta_engine = DeltaEngine()
@@ -2,38 +2,137 @@
 # vim: noet shiftwidth=4 tabstop=4
 
 from collector.sources.Command import Command
+from collector.sources.delta import delta_engine
 from collector.sources import compute_difference_over_dictonaries, field_converter_integer, field_converter_float, field_converter_time, field_converter_kilobyte
 from collector import Document
-import re
+import re, heapq, time
+
+class ProcessFilter:
+	"""
+	Selects the processes of a ps table documents are built for. Processes
+	are matched by user, state, comm regex, cgroup regex and whether their
+	counters changed, then optionally limited to the top N by a field.
+	Groups are taken from a PidIndex a cgroup source published to, else read
+	from the cgroup file of the process below proc.
+	"""
+
+	COUNTER_FIELDS = ["time", "maj_flt", "min_flt", "rchar", "wchar", "read_bytes", "write_bytes"]
+
+	def __init__(self, users=None, states=None, comm=None, cgroup=None, changed=False, top=None, sort="pcpu", proc="/proc"):
+		self.users = users and set(users)
+		self.states = states and set(states)
+		self.comm = comm and re.compile(comm)
+		self.cgroup = cgroup and re.compile(cgroup)
+		self.changed = changed
+		self.top = top
+		self.sort = sort
+		self.proc = proc
+
+	def has_changed(self, data, last):
+		if last == None:
+			return True
+
+		for field in ProcessFilter.COUNTER_FIELDS:
+			if field in data and data[field] != last.get(field):
+				return True
+
+		return False
+
+	def in_cgroup(self, pid, pid_index=None):
+		if pid_index != None and pid_index.published:
+			groups = pid_index.lookup(int(pid))
+			if groups != None:
+				for group in groups.values():
+					if self.cgroup.search(group):
+						return True
+
+				return False
+
+		try:
+			with open("%s/%s/cgroup" % (self.proc, pid), "r") as f:
+				for line in f:
+					if self.cgroup.search(line.split(":", 2)[-1]):
+						return True
+		except OSError:
+			None
+
+		return False
+
+	def sort_key(self, data):
+		v = data.get(self.sort)
+		if type(v) == int or type(v) == float:
+			return v
+		else:
+			return 0
+
+	def select(self, pids, last_pids, pid_index=None):
+		r = []
+
+		for pid in pids:
+			data = pids[pid]
+
+			if self.users != None and data.get("user") not in self.users:
+				continue
+
+			if self.states != None and data.get("state", "")[:1] not in self.states:
+				continue
+
+			if self.comm != None and self.comm.search(data.get("comm", "")) == None:
+				continue
 
-regex_compress = re.compile("( )+")
-regex_begin = re.compile("^( )+")
+			if self.changed and not self.has_changed(data, last_pids.get(pid)):
+				continue
+
+			r += [pid]
+
+		# most expensive, reads a file per process
+		if self.cgroup != None:
+			r = [pid for pid in r if self.in_cgroup(pid, pid_index)]
+
+		if self.top != None:
+			r = heapq.nlargest(self.top, r, key=lambda pid: self.sort_key(pids[pid]))
 
-def ps_time_to_seconds(strtime):
-	m = regex_time.match(strtime)
-	if m == None:
-		return None
-	else:
-		total = 0
-		(_, days, _, hours, _, minutes, seconds) = m.groups()
+		return r
 
-		if seconds != None:
-			total += int(seconds)
+class ProcessState:
+	"""
+	State of a process for deltas, its start time and the DeltaState of its
+	fields. Numeric fields can be looked up by name.
+	"""
 
-		if minutes != None:
-			total += int(minutes)*60
+	__slots__ = ("starttime", "snapshot")
 
-		if hours != None:
-			total += int(hours)*60*60
+	def __init__(self, starttime, snapshot):
+		self.starttime = starttime
+		self.snapshot = snapshot
 
-		if days != None:
-			total += int(days)*24*60*60
+	def __contains__(self, key):
+		return key in self.snapshot
 
-		return total
+	def __getitem__(self, key):
+		return self.snapshot[key]
+
+	def get(self, key, default=None):
+		return self.snapshot.get(key, default)
 
 class PS(Command):
-	def __init__(self, ps="/bin/ps", fields=["pid"]):
+	# start times derived from etime have a resolution of a second and are
+	# floored, the runtime of ps adds jitter, so they differ by up to 2s
+	STARTTIME_TOLERANCE = 2
+
+	# fields summed up by aggregates
+	AGGREGATE_FIELDS = ["pcpu", "pmem", "rss", "vsz", "maj_flt", "min_flt"]
+
+	def __init__(self, ps="/bin/ps", fields=["pid"], filter=None, aggregate=None, tree_depth=1):
 		self.fields = fields
+		self.filter = filter
+		# any of "user", "comm" and "tree"
+		self.aggregate = aggregate or []
+		self.tree_depth = tree_depth
+		self.aggregates = { }
+		self.last_aggregates = { }
+		# shared PidIndex, if processes are joined with groups
+		self.pid_index = None
 
 		field_list = ""
 		for i in range(0, len(self.fields)):
@@ -45,83 +144,251 @@ class PS(Command):
 		Command.__init__(self, ps, ["-axo", field_list])
 
 		self.pids = { }
+		# pid -> ProcessState of the previous tick, only for running processes
 		self.last_pids = { }
+		self.history = { }
 		self.field_converter = { }
+		self.layout = ()
 
 		self.add_field_converter("pid", field_converter_integer)
 
 	def add_field_converter(self, name, conv):
 		self.field_converter[name] = conv
+		self.compile_layout()
 
-	def update(self):
-		global regex_compress, regex_begin
+	def compile_layout(self):
+		"""
+		Compiles the fields into a tuple of (index, name, converter), so
+		parsing a line needs no further lookups.
+		"""
+		layout = []
 
-		self.last_pids = self.pids.copy()
-		self.pids = { }
-		Command.update(self)
-		
-		# get lines from output
-		lines = self.data_stdout.decode("UTF-8")
-		lines = lines.split("\n")
-		# drop header
-		lines = lines[1:]
+		for i in range(0, len(self.fields)):
+			field = self.fields[i].lower()
+			if field == "pid":
+				# pids are kept as printed, they're used as keys
+				conv = None
+			else:
+				conv = self.field_converter.get(field)
 
-		r = []
+			layout += [(i, field, conv)]
+
+		self.layout = tuple(layout)
+		self.pid_column = [i for i, field, conv in layout if field == "pid"]
+
+	def parse(self, output):
+		"""
+		Parses the output of ps into self.pids.
+		"""
+		layout = self.layout
+		n = len(layout)
+		if len(self.pid_column) == 0:
+			return
 
-		for line in lines:
-			# compress white spaces
-			d = regex_compress.sub(" ", line)
-			d = regex_begin.sub("", d)
-			ar = d.split(" ", len(self.fields)-1)
-			if len(d) == 0 or len(d[0]) == 0:
+		pid_column = self.pid_column[0]
+
+		lines = output.decode("UTF-8").split("\n")
+
+		# drop header
+		for line in lines[1:]:
+			ar = line.split(None, n-1)
+			if len(ar) < n:
 				continue
 
-			# create field list
 			data = { }
-			pid = None
-			for i in range(0, len(self.fields)):
-				field = self.fields[i].lower()
+			for i, field, conv in layout:
+				v = ar[i]
+				if v == "-" and i != pid_column:
+					continue
+
+				if conv != None:
+					v = conv(v)
+					if v == None:
+						continue
+
+				data[field] = v
+
+			self.pids[ar[pid_column]] = data
+
+	def process_starttime(self, pid, data):
+		if "etime" in data:
+			return int(self.now-data["etime"])
+		else:
+			return None
 
-				if field == "pid":
-					pid = ar[i]
+	def update_history(self):
+		"""
+		Moves the state of still running processes into self.last_pids and
+		records the current state. Exited processes are dropped, a pid with
+		another start time is taken as a new process.
+		"""
+		last = { }
+		history = { }
+
+		for pid in self.pids:
+			data = self.pids[pid]
+			starttime = self.process_starttime(pid, data)
+
+			state = self.history.get(pid)
+			if state != None:
+				if state.starttime == None or starttime == None or abs(state.starttime-starttime) <= self.STARTTIME_TOLERANCE:
+					# only the numbers are needed for deltas
+					state.snapshot.values = None
+					last[pid] = state
+
+			history[pid] = ProcessState(starttime, delta_engine.snapshot(data))
+
+		self.last_pids = last
+		self.history = history
+
+	def update(self):
+		self.pids = { }
+		Command.update(self)
+		self.now = time.time()
+		self.parse(self.data_stdout)
+		self.update_history()
+
+	def select(self):
+		"""
+		Returns the pids documents are built for.
+		"""
+		if self.filter == None:
+			return list(self.pids)
+		else:
+			return self.filter.select(self.pids, self.last_pids, self.pid_index)
+
+	def tree_roots(self):
+		"""
+		Returns the root of the subtree at tree_depth every process belongs to,
+		processes above tree_depth have none. Depths are computed with a
+		memoized walk up the ppid chain, roots in order of the depth.
+		"""
+		depth = { }
+
+		for pid in self.pids:
+			chain = []
+			p = pid
+			while p not in depth:
+				chain += [p]
+				ppid = self.pids[p].get("ppid")
+				if ppid not in self.pids or ppid in chain:
+					depth[p] = 0
+					chain.pop()
+					break
+
+				p = ppid
+
+			for i in reversed(chain):
+				depth[i] = depth[self.pids[i]["ppid"]]+1
+
+		by_depth = { }
+		for pid in depth:
+			by_depth.setdefault(depth[pid], []).append(pid)
+
+		roots = { }
+		for d in sorted(by_depth):
+			if d < self.tree_depth:
+				continue
+
+			for pid in by_depth[d]:
+				if d == self.tree_depth:
+					roots[pid] = pid
 				else:
-					if ar[i] == "-":
-						continue
+					roots[pid] = roots[self.pids[pid]["ppid"]]
 
-					if field in self.field_converter:
-						v = self.field_converter[field](ar[i])
-						if v != None:
-							data[field] = v
+		return roots
 
-						continue
+	def update_aggregates(self):
+		"""
+		Sums up the AGGREGATE_FIELDS, process and thread counts per user, comm
+		and subtree in a single pass over the process table.
+		"""
+		self.last_aggregates = self.aggregates
+		self.aggregates = { }
+		if len(self.aggregate) == 0:
+			return
 
-				data[field] = ar[i]
+		if "tree" in self.aggregate:
+			roots = self.tree_roots()
+		else:
+			roots = { }
 
-			if pid != None:
-				self.pids[pid] = data
+		for pid in self.pids:
+			data = self.pids[pid]
+			keys = []
+
+			for group_by in ["user", "comm"]:
+				if group_by in self.aggregate and group_by in data:
+					keys += [(group_by, data[group_by])]
+
+			if pid in roots:
+				root = roots[pid]
+				keys += [("tree", "%s %s" % (root, self.pids[root].get("comm", "")))]
+
+			for key in keys:
+				if key not in self.aggregates:
+					self.aggregates[key] = { "processes": 0, "threads": 0 }
+
+				t = self.aggregates[key]
+				t["processes"] += 1
+				t["threads"] += data.get("nlwp", 1)
+
+				for field in self.AGGREGATE_FIELDS:
+					v = data.get(field)
+					if v != None:
+						t[field] = t.get(field, 0)+v
+
+	def aggregate_docs(self, envelope):
+		docs = []
+		doc_type = self.name + "Aggregate"
+
+		for key in self.aggregates:
+			group_by, value = key
+			data = { "name": "%s:%s" % (group_by, value) }
+			data[doc_type] = compute_difference_over_dictonaries(self.aggregates[key], self.last_aggregates.get(key, { }), self.get_timedelta())
+			data[doc_type]["group_by"] = group_by
+			data[doc_type]["key"] = value
+			docs += [Document(self.name, doc_type=doc_type, doc_data=data, key=self.document_key(group_by, value), envelope=envelope)]
+
+		return docs
 
 	def docs(self):
 		self.update()
-		basedoc = self.get_base_information()
-		docs = []
+		self.update_aggregates()
+		envelope = self.get_base_information()
+		docs = self.aggregate_docs(envelope)
+		selected = self.select()
+
+		if self.pid_index != None:
+			self.pid_index.set_processes(self.pids)
+			if not self.pid_index.published:
+				self.pid_index.read_groups([int(pid) for pid in selected])
+
+		timedelta = self.get_timedelta()
+		for pid in selected:
+			data = { }
+			last = self.last_pids.get(pid)
+			if last != None:
+				last = last.snapshot
 
-		for pid in self.pids:
-			data = basedoc.copy()
-			if pid in self.last_pids:
-				data[self.name] = compute_difference_over_dictonaries(self.pids[pid], self.last_pids[pid], self.get_timedelta())
-			else:
-				data[self.name] = compute_difference_over_dictonaries(self.pids[pid], { }, self.get_timedelta())
+			data[self.name] = delta_engine.difference(self.history[pid].snapshot, last, timedelta)
 
 			data[self.name]["pid"] = pid
 			data["pids"] = [pid]
-			docs += [Document(self.name, doc_type=self.name, doc_data=data)]
+
+			if self.pid_index != None:
+				cgroups = self.pid_index.lookup(int(pid))
+				if cgroups != None:
+					data["cgroups"] = cgroups
+			key = self.document_key(pid, self.history[pid].starttime)
+			docs += [Document(self.name, doc_type=self.name, doc_data=data, key=key, envelope=envelope)]
 	
 		return docs 
 
 
 class UnixPS(PS):
-	def __init__(self, ps="/bin/ps", fields=["pid", "ppid", "pgid", "pcpu", "ruser", "user", "rgroup", "group", "time", "etime", "vsz", "nice", "tty", "comm", "args"]):
-		PS.__init__(self, ps=ps, fields=fields)
+	def __init__(self, ps="/bin/ps", fields=["pid", "ppid", "pgid", "pcpu", "ruser", "user", "rgroup", "group", "time", "etime", "vsz", "nice", "tty", "comm", "args"], filter=None, aggregate=None, tree_depth=1):
+		PS.__init__(self, ps=ps, fields=fields, filter=filter, aggregate=aggregate, tree_depth=tree_depth)
 		self.name = "UnixPS"
 		self.add_field_converter("pcpu", field_converter_float)
 		self.add_field_converter("vsz", field_converter_kilobyte)
@@ -131,8 +398,8 @@ class UnixPS(PS):
 
 
 class LinuxPS(UnixPS):
-	def __init__(self, ps="/bin/ps", fields=["pid", "ppid", "pgid", "pcpu", "ruser", "user", "rgroup", "group", "time", "etime", "vsz", "nice", "tty", "euid", "egid", "ruid", "rgid", "fuid", "fuser", "fgid", "fgroup", "suid", "sgid", "pending", "class", "rss", "drs", "trs", "size", "eip", "esp", "stackp", "mntns", "netns", "pidns","ipcns", "label", "maj_flt", "min_flt", "nlwp", "psr", "rtprio", "sched", "state", "comm", "pmem", "command"]):
-		UnixPS.__init__(self, ps=ps, fields=fields)
+	def __init__(self, ps="/bin/ps", fields=["pid", "ppid", "pgid", "pcpu", "ruser", "user", "rgroup", "group", "time", "etime", "vsz", "nice", "tty", "euid", "egid", "ruid", "rgid", "fuid", "fuser", "fgid", "fgroup", "suid", "sgid", "pending", "class", "rss", "drs", "trs", "size", "eip", "esp", "stackp", "mntns", "netns", "pidns","ipcns", "label", "maj_flt", "min_flt", "nlwp", "psr", "rtprio", "sched", "state", "comm", "pmem", "command"], filter=None, aggregate=None, tree_depth=1):
+		UnixPS.__init__(self, ps=ps, fields=fields, filter=filter, aggregate=aggregate, tree_depth=tree_depth)
 		self.name = "LinuxPS"
 		self.add_field_converter("pmem", field_converter_float)
 
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+
+from collector import Source
+from collector.sources.ps import LinuxPS
+from collector.sources import field_converter_integer
+import os, pwd, grp
+
+PROCFS_FIELDS = ["pid", "ppid", "pgid", "pcpu", "ruser", "user", "rgroup", "group", "time", "etime", "vsz", "nice", "euid", "egid", "ruid", "rgid", "fuid", "fuser", "fgid", "fgroup", "suid", "sgid", "pending", "class", "rss", "drs", "trs", "mntns", "netns", "pidns", "ipcns", "maj_flt", "min_flt", "nlwp", "psr", "rtprio", "sched", "state", "comm", "pmem", "command", "rchar", "wchar", "syscr", "syscw", "read_bytes", "write_bytes", "cancelled_write_bytes"]
+
+# field -> file of /proc/<pid> it is read from
+FIELD_FILES = {
+	"ppid": "stat", "pgid": "stat", "pcpu": "stat", "time": "stat", "etime": "stat",
+	"vsz": "stat", "nice": "stat", "class": "stat", "rss": "stat", "maj_flt": "stat",
+	"min_flt": "stat", "nlwp": "stat", "psr": "stat", "rtprio": "stat", "sched": "stat",
+	"state": "stat", "comm": "stat", "pmem": "stat", "drs": "stat", "trs": "stat",
+	"ruser": "status", "user": "status", "rgroup": "status", "group": "status",
+	"euid": "status", "egid": "status", "ruid": "status", "rgid": "status",
+	"fuid": "status", "fuser": "status", "fgid": "status", "fgroup": "status",
+	"suid": "status", "sgid": "status", "pending": "status",
+	"mntns": "ns", "netns": "ns", "pidns": "ns", "ipcns": "ns",
+	"rchar": "io", "wchar": "io", "syscr": "io", "syscw": "io", "read_bytes": "io",
+	"write_bytes": "io", "cancelled_write_bytes": "io",
+	"command": "cmdline", "args": "cmdline",
+}
+
+SCHED_CLASS = { 0: "TS", 1: "FF", 2: "RR", 3: "B", 5: "IDL", 6: "DLN" }
+
+def read_file(path):
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		r = b''
+		while True:
+			d = os.read(fd, 65536)
+			if len(d) == 0:
+				return r
+
+			r += d
+	finally:
+		os.close(fd)
+
+class ProcFS(LinuxPS):
+	"""
+	Reads the process table directly from /proc instead of running ps. Field
+	names, units and types are the same as of LinuxPS, fields not known here
+	are left out.
+	"""
+
+	# start times are exact clock ticks
+	STARTTIME_TOLERANCE = 0
+
+	def __init__(self, proc="/proc", fields=PROCFS_FIELDS, filter=None, aggregate=None, tree_depth=1):
+		LinuxPS.__init__(self, fields=fields, filter=filter, aggregate=aggregate, tree_depth=tree_depth)
+		self.name = "ProcFS"
+		self.proc = proc
+		if filter != None:
+			filter.proc = proc
+
+		for i in ["rchar", "wchar", "syscr", "syscw", "read_bytes", "write_bytes", "cancelled_write_bytes"]:
+			self.add_field_converter(i, field_converter_integer)
+
+		self.wanted = [f.lower() for f in self.fields if f.lower() in FIELD_FILES]
+		self.files = set([FIELD_FILES[f] for f in self.wanted])
+		self.hz = float(os.sysconf("SC_CLK_TCK"))
+		self.pagesize = os.sysconf("SC_PAGE_SIZE")
+		self.memtotal = self.read_memtotal()
+		self.users = { }
+		self.groups = { }
+		self.starttimes = { }
+
+	def read_memtotal(self):
+		for line in read_file(self.proc + "/meminfo").split(b"\n"):
+			if line.startswith(b"MemTotal:"):
+				return int(line.split()[1])*1024
+
+		return None
+
+	def user_name(self, uid):
+		if uid not in self.users:
+			try:
+				self.users[uid] = pwd.getpwuid(uid).pw_name
+			except KeyError:
+				self.users[uid] = str(uid)
+
+		return self.users[uid]
+
+	def group_name(self, gid):
+		if gid not in self.groups:
+			try:
+				self.groups[gid] = grp.getgrgid(gid).gr_name
+			except KeyError:
+				self.groups[gid] = str(gid)
+
+		return self.groups[gid]
+
+	def read_stat(self, path, uptime, r):
+		d = read_file(path + "/stat").decode("UTF-8", errors="replace")
+		# comm may contain spaces and parentheses
+		end = d.rfind(")")
+		r["comm"] = d[d.find("(")+1:end]
+		v = d[end+2:].split(" ")
+
+		cputime = (int(v[11])+int(v[12]))/self.hz
+		r["starttime"] = int(v[19])
+		start = r["starttime"]/self.hz
+		rss = int(v[21])*self.pagesize
+		# like ps, text size in full kilobytes
+		text = (max(int(v[24])-int(v[23]), 0) >> 10)*1024
+		policy = int(v[38])
+
+		r["state"] = v[0]
+		r["ppid"] = v[1]
+		r["pgid"] = v[2]
+		r["min_flt"] = int(v[7])
+		r["maj_flt"] = int(v[9])
+		r["time"] = int(cputime)
+		r["nice"] = int(v[16])
+		r["nlwp"] = int(v[17])
+		r["vsz"] = int(v[20])
+		r["rss"] = rss
+		r["trs"] = text
+		r["drs"] = int(v[20])-text
+		r["psr"] = int(v[36])
+		r["sched"] = policy
+		r["class"] = SCHED_CLASS.get(policy, "#%i" % (policy))
+		if policy == 1 or policy == 2:
+			r["rtprio"] = int(v[37])
+
+		# by uptime, unaffected by changes of the wall clock
+		r["etime"] = int(uptime-start)
+
+		if uptime-start > 0:
+			r["pcpu"] = int(cputime*1000.0/(uptime-start))/10.0
+		else:
+			r["pcpu"] = 0.0
+
+		if self.memtotal:
+			r["pmem"] = int(rss*1000.0/self.memtotal)/10.0
+
+	def read_status(self, path, r):
+		for line in read_file(path + "/status").split(b"\n"):
+			if line.startswith(b"Uid:"):
+				ruid, euid, suid, fuid = [int(i) for i in line.split()[1:5]]
+				r["ruid"] = ruid
+				r["euid"] = euid
+				r["suid"] = suid
+				r["fuid"] = fuid
+				r["ruser"] = self.user_name(ruid)
+				r["user"] = self.user_name(euid)
+				r["fuser"] = self.user_name(fuid)
+
+			elif line.startswith(b"Gid:"):
+				rgid, egid, sgid, fgid = [int(i) for i in line.split()[1:5]]
+				r["rgid"] = rgid
+				r["egid"] = egid
+				r["sgid"] = sgid
+				r["fgid"] = fgid
+				r["rgroup"] = self.group_name(rgid)
+				r["group"] = self.group_name(egid)
+				r["fgroup"] = self.group_name(fgid)
+
+			elif line.startswith(b"SigPnd:"):
+				r["pending"] = line.split()[1].decode("ASCII")
+
+	def read_ns(self, path, r):
+		for i in ["mnt", "net", "pid", "ipc"]:
+			# e.g. "mnt:[4026531840]"
+			l = os.readlink("%s/ns/%s" % (path, i))
+			r[i + "ns"] = int(l[l.find("[")+1:-1])
+
+	def read_io(self, path, r):
+		for line in read_file(path + "/io").split(b"\n"):
+			kv = line.split(b": ")
+			if len(kv) == 2:
+				r[kv[0].decode("ASCII")] = int(kv[1])
+
+	def read_cmdline(self, path, r):
+		d = read_file(path + "/cmdline").rstrip(b"\0").replace(b"\0", b" ").decode("UTF-8", errors="replace")
+		if len(d) == 0:
+			d = "[%s]" % (r.get("comm", ""))
+
+		r["command"] = d
+		r["args"] = d
+
+	def read_process(self, pid, uptime):
+		path = "%s/%s" % (self.proc, pid)
+		r = { }
+
+		# stat is always needed for the start time
+		self.read_stat(path, uptime, r)
+
+		if "status" in self.files:
+			self.read_status(path, r)
+
+		# only readable for own processes without privileges
+		for f, func in [("ns", self.read_ns), ("io", self.read_io)]:
+			if f in self.files:
+				try:
+					func(path, r)
+				except PermissionError:
+					None
+
+		if "cmdline" in self.files:
+			self.read_cmdline(path, r)
+
+		self.starttimes[pid] = r.get("starttime")
+
+		data = { "pid": pid }
+		for field in self.wanted:
+			if field not in r:
+				continue
+
+			if field in self.field_converter:
+				data[field] = r[field]
+			else:
+				# keep the types of fields ps prints as strings
+				data[field] = str(r[field])
+
+		return data
+
+	def process_starttime(self, pid, data):
+		return self.starttimes.get(pid)
+
+	def update(self):
+		Source.update(self)
+
+		self.pids = { }
+		self.starttimes = { }
+
+		uptime = float(read_file(self.proc + "/uptime").split()[0])
+
+		for pid in os.listdir(self.proc):
+			if not pid.isdigit():
+				continue
+
+			try:
+				self.pids[pid] = self.read_process(pid, uptime)
+			except (FileNotFoundError, ProcessLookupError):
+				# process exited while being read
+				continue
+			except (ValueError, IndexError):
+				# file vanished half way or kernel thread without details
+				continue
+
+		self.update_history()
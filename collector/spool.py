@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# vim: noet shiftwidth=4 tabstop=4
+
+from collector import Document, DocumentBatch
+from collector.targets import datetime2iso_corrector
+import os, json, struct, threading, time, zlib, logging
+
+# length and crc32 of the record following
+RECORD_HEADER = struct.Struct(">II")
+
+def encode_batch(batch):
+	envelopes = { }
+	r = { "source": batch.source, "envelopes": [], "docs": [] }
+
+	for doc in batch:
+		e = None
+		if doc.envelope != None:
+			if id(doc.envelope) not in envelopes:
+				envelopes[id(doc.envelope)] = len(r["envelopes"])
+				r["envelopes"] += [datetime2iso_corrector(doc.envelope)]
+
+			e = envelopes[id(doc.envelope)]
+
+		# the id is kept, a replayed document replaces the one possibly
+		# delivered before
+		r["docs"] += [[doc.source, doc.id(), doc.type(), datetime2iso_corrector(doc.payload()), e]]
+
+	return json.dumps(r).encode("UTF-8")
+
+def decode_batch(data):
+	r = json.loads(data.decode("UTF-8"))
+	envelopes = r["envelopes"]
+	batch = DocumentBatch(r["source"], envelopes[0] if len(envelopes) > 0 else None)
+
+	for source, doc_id, doc_type, payload, e in r["docs"]:
+		batch.add(Document(source, doc_id=doc_id, doc_type=doc_type, doc_data=payload, envelope=envelopes[e] if e != None else None))
+
+	return batch
+
+class Spool:
+	"""
+	Write-ahead spool of DocumentBatches in a directory of append-only
+	segment files, read back in the order written. Records are length
+	prefixed and checksummed, a record torn by a crash ends its segment.
+	Writes are synced to disk at most every sync_interval seconds, the
+	oldest segments are dropped once the spool exceeds max_bytes. The read
+	position is kept in the directory, so a restarted collector continues
+	where it stopped.
+	"""
+
+	SEGMENT_SUFFIX = ".spool"
+
+	def __init__(self, directory, segment_bytes=16777216, max_bytes=1073741824, sync_interval=1.0):
+		self.directory = directory
+		# several segments within max_bytes, so dropping one keeps most
+		self.segment_bytes = min(segment_bytes, max(max_bytes//8, 1))
+		self.max_bytes = max_bytes
+		self.sync_interval = sync_interval
+		self.lock = threading.Lock()
+		self.log = logging.getLogger(__name__)
+
+		os.makedirs(directory, exist_ok=True)
+
+		# segment number -> size in bytes
+		self.sizes = { }
+		for f in os.listdir(directory):
+			if f.endswith(Spool.SEGMENT_SUFFIX) and f[:-len(Spool.SEGMENT_SUFFIX)].isdigit():
+				self.sizes[int(f[:-len(Spool.SEGMENT_SUFFIX)])] = os.path.getsize(os.path.join(directory, f))
+
+		self.segments = sorted(self.sizes)
+		self.bytes = sum(self.sizes.values())
+
+		# a restart always appends to a new segment, only the last one
+		# written may end in a torn record
+		self.writer = None
+		self.writer_segment = None
+		self.synced = time.monotonic()
+		self.unsynced = False
+
+		self.reader = None
+		self.reader_segment = None
+		self.read_segment, self.read_offset = self.read_position()
+
+		# counters of documents
+		self.written = 0
+		self.dropped_bytes = 0
+
+	def path(self, segment):
+		return os.path.join(self.directory, "%012i%s" % (segment, Spool.SEGMENT_SUFFIX))
+
+	def read_position(self):
+		try:
+			with open(os.path.join(self.directory, "position")) as f:
+				segment, offset = [int(i) for i in f.read().split()]
+		except (OSError, ValueError):
+			segment, offset = (None, 0)
+
+		if segment not in self.sizes:
+			if len(self.segments) == 0:
+				return (None, 0)
+
+			return (self.segments[0], 0)
+
+		# segments before the position were read completely
+		for s in [s for s in self.segments if s < segment]:
+			self.remove(s)
+
+		return (segment, offset)
+
+	def write_position(self):
+		p = os.path.join(self.directory, "position")
+		with open(p + ".tmp", "w") as f:
+			f.write("%i %i\n" % (self.read_segment if self.read_segment != None else -1, self.read_offset))
+
+		os.replace(p + ".tmp", p)
+
+	def remove(self, segment):
+		if self.reader != None and self.reader_segment == segment:
+			self.reader.close()
+			self.reader = None
+
+		try:
+			os.unlink(self.path(segment))
+		except FileNotFoundError:
+			None
+
+		self.bytes -= self.sizes.pop(segment)
+		self.segments.remove(segment)
+
+	def roll(self):
+		if self.writer != None:
+			self.sync()
+			self.writer.close()
+
+		if len(self.segments) > 0:
+			self.writer_segment = self.segments[-1]+1
+		else:
+			self.writer_segment = 0
+
+		# unbuffered, records are readable as soon as they are written
+		self.writer = open(self.path(self.writer_segment), "ab", buffering=0)
+		self.segments += [self.writer_segment]
+		self.sizes[self.writer_segment] = 0
+
+		if self.read_segment == None:
+			self.read_segment = self.writer_segment
+			self.read_offset = 0
+
+	def sync(self):
+		if self.writer != None and self.unsynced:
+			os.fsync(self.writer.fileno())
+
+		self.unsynced = False
+		self.synced = time.monotonic()
+
+	def write(self, batch):
+		if len(batch) == 0:
+			return
+
+		data = encode_batch(batch)
+		record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+		with self.lock:
+			if self.writer == None or self.sizes[self.writer_segment] >= self.segment_bytes:
+				self.roll()
+
+			self.writer.write(record)
+			self.sizes[self.writer_segment] += len(record)
+			self.bytes += len(record)
+			self.written += len(batch)
+			self.unsynced = True
+
+			if time.monotonic()-self.synced >= self.sync_interval:
+				self.sync()
+
+			while self.bytes > self.max_bytes and len(self.segments) > 1:
+				segment = self.segments[0]
+				self.log.warning("spool %s full, dropping segment %i", self.directory, segment)
+				self.dropped_bytes += self.sizes[segment]
+				if segment == self.read_segment:
+					self.read_segment = self.segments[1]
+					self.read_offset = 0
+
+				self.remove(segment)
+
+	def empty(self):
+		with self.lock:
+			return self.read_segment == None or (self.read_segment == self.segments[-1] and self.read_offset >= self.sizes[self.read_segment])
+
+	def peek(self):
+		"""
+		Returns the oldest batch not yet acknowledged and the position to
+		acknowledge it with, None if the spool is empty.
+		"""
+		with self.lock:
+			while self.read_segment != None:
+				if self.reader == None or self.reader_segment != self.read_segment:
+					if self.reader != None:
+						self.reader.close()
+
+					self.reader = open(self.path(self.read_segment), "rb")
+					self.reader_segment = self.read_segment
+
+				self.reader.seek(self.read_offset)
+				header = self.reader.read(RECORD_HEADER.size)
+				data = None
+
+				if len(header) == RECORD_HEADER.size:
+					length, crc = RECORD_HEADER.unpack(header)
+					data = self.reader.read(length)
+					if len(data) != length or zlib.crc32(data) != crc:
+						self.log.warning("spool %s: torn record in segment %i at %i", self.directory, self.read_segment, self.read_offset)
+						data = None
+
+				if data != None:
+					return (decode_batch(data), (self.read_segment, self.read_offset+RECORD_HEADER.size+len(data)))
+
+				if self.read_segment == self.writer_segment:
+					return None
+
+				# end of a segment written completely
+				segment = self.read_segment
+				i = self.segments.index(segment)
+				if i+1 < len(self.segments):
+					self.read_segment = self.segments[i+1]
+				else:
+					self.read_segment = None
+
+				self.read_offset = 0
+				self.remove(segment)
+				self.write_position()
+
+			return None
+
+	def ack(self, position):
+		"""
+		Marks the batches up to position as delivered.
+		"""
+		with self.lock:
+			segment, offset = position
+			if segment != self.read_segment:
+				# dropped meanwhile
+				return
+
+			self.read_offset = offset
+			self.write_position()
+
+	def close(self):
+		with self.lock:
+			if self.writer != None:
+				self.sync()
+				self.writer.close()
+				self.writer = None
+				# written completely, a reopened spool appends to a new one
+				self.writer_segment = None
+
+			if self.reader != None:
+				self.reader.close()
+				self.reader = None
@@ -20,6 +20,55 @@ def datetime2iso_corrector(data):
 
 	return r
 
+def merged_documents(batch):
+	"""
+	Yields every document of batch with its data corrected by
+	datetime2iso_corrector, envelopes are corrected only once.
+	"""
+	envelopes = { }
+
+	for doc in batch:
+		d = datetime2iso_corrector(doc.payload())
+
+		if doc.envelope != None:
+			if id(doc.envelope) not in envelopes:
+				envelopes[id(doc.envelope)] = datetime2iso_corrector(doc.envelope)
+
+			e = envelopes[id(doc.envelope)].copy()
+			e.update(d)
+			d = e
+
+		yield (doc, d)
+
+def json_documents(batch, fields):
+	"""
+	Yields every document of batch serialized to JSON, with the additional
+	fields returned by fields(doc). Envelopes are serialized once and put in
+	front of the serialized payloads.
+	"""
+	envelopes = { }
+
+	for doc in batch:
+		d = datetime2iso_corrector(doc.payload())
+		d.update(fields(doc))
+
+		if doc.envelope == None:
+			yield (doc, json.dumps(d))
+			continue
+
+		if id(doc.envelope) not in envelopes:
+			e = datetime2iso_corrector(doc.envelope)
+			envelopes[id(doc.envelope)] = (e, json.dumps(e)[1:-1])
+
+		e, head = envelopes[id(doc.envelope)]
+		if len(d) > 0 and len(e) > 0 and e.keys().isdisjoint(d):
+			yield (doc, "{" + head + ", " + json.dumps(d)[1:])
+		else:
+			# payload overrides envelope fields
+			m = e.copy()
+			m.update(d)
+			yield (doc, json.dumps(m))
+
 class Console(Target):
 	def __init__(self, format=None, use_stderr=False):
 		Target.__init__(self, "Console")
@@ -44,3 +93,18 @@ class Console(Target):
 			out.write(json.dumps(d, indent=2)+"\n")
 		else:
 			out.write(str(doc)+"\n")
+
+	def push_batch(self, batch):
+		if self.format != "json":
+			Target.push_batch(self, batch)
+			return
+
+		if self.use_stderr == True:
+			out = sys.stderr
+		else:
+			out = sys.stdout
+
+		for doc, d in merged_documents(batch):
+			d["id"] = doc.id()
+			d["type"] = doc.type()
+			out.write(json.dumps(d, indent=2)+"\n")
@@ -2,23 +2,397 @@
 # vim: ts=4 sw=4 noet
 
 from datetime import datetime
-import logging, elasticsearch
-from collector import Target, Document
+from urllib.parse import urlsplit, unquote
+import logging, json, threading, time, random, queue, http.client, ssl, base64
+from collector import Target, Document, DocumentBatch
+from collector.targets import json_documents
+
+def parse_host(host):
+	"""
+	Returns (scheme, host, port, authorization) of "HOST", "HOST:PORT" or an
+	URL, the authorization header is built from user and password of the URL.
+	"""
+	if host.find("://") < 0:
+		host = "http://" + host
+
+	u = urlsplit(host)
+	port = u.port
+	if port == None:
+		port = 443 if u.scheme == "https" else 9200
+
+	authorization = None
+	if u.username != None:
+		credentials = "%s:%s" % (unquote(u.username), unquote(u.password or ""))
+		authorization = "Basic " + base64.b64encode(credentials.encode("UTF-8")).decode("ASCII")
+
+	return (u.scheme, u.hostname, port, authorization)
+
+def host_name(host):
+	# without credentials
+	return "%s://%s:%i" % host[:3]
+
+class HostPool:
+	"""
+	Keep-alive connections to the Elasticsearch hosts, handed out round-robin.
+	A failing host is marked dead and skipped for dead_timeout seconds,
+	doubling with every further failure. If all hosts are dead, the one to be
+	retried first is used anyway.
+	"""
+
+	def __init__(self, hosts, dead_timeout=5.0, max_dead_timeout=60.0, ssl_context=None):
+		self.hosts = [parse_host(h) for h in hosts]
+		self.ssl_context = ssl_context
+		self.dead_timeout = dead_timeout
+		self.max_dead_timeout = max_dead_timeout
+		# host -> idle connections
+		self.idle = dict([(h, []) for h in self.hosts])
+		# host -> (time to retry, failures)
+		self.dead = { }
+		self.next = 0
+		self.lock = threading.Lock()
+
+	def acquire(self, timeout=None):
+		with self.lock:
+			now = time.monotonic()
+			alive = [h for h in self.hosts if h not in self.dead or self.dead[h][0] <= now]
+			if len(alive) == 0:
+				alive = [min(self.dead, key=lambda h: self.dead[h][0])]
+
+			host = alive[self.next % len(alive)]
+			self.next += 1
+
+			if len(self.idle[host]) > 0:
+				return (host, self.idle[host].pop())
+
+		scheme, hostname, port, authorization = host
+		if scheme == "https":
+			conn = http.client.HTTPSConnection(hostname, port, timeout=timeout, context=self.ssl_context)
+		else:
+			conn = http.client.HTTPConnection(hostname, port, timeout=timeout)
+
+		return (host, conn)
+
+	def release(self, host, conn):
+		with self.lock:
+			self.dead.pop(host, None)
+			self.idle[host] += [conn]
+
+	def fail(self, host, conn):
+		conn.close()
+
+		with self.lock:
+			failures = self.dead.get(host, (0, 0))[1]
+			wait = min(self.dead_timeout*2**failures, self.max_dead_timeout)
+			self.dead[host] = (time.monotonic()+wait, failures+1)
+
+	def available(self):
+		with self.lock:
+			now = time.monotonic()
+			return len([h for h in self.hosts if h not in self.dead or self.dead[h][0] <= now]) > 0
+
+	def close(self):
+		with self.lock:
+			for host in self.idle:
+				for conn in self.idle[host]:
+					conn.close()
+
+				self.idle[host] = []
+
+class Confirmation:
+	"""
+	Outcome of the documents of a batch, which may be sent in several bulk
+	requests. Calls done like Target.push_confirmed once all are settled.
+	"""
+
+	def __init__(self, size, done):
+		self.pending = size
+		self.done = done
+		self.delivered = 0
+		self.failed = []
+		self.error = None
+		self.lock = threading.Lock()
+
+	def settle(self, delivered=0, failed=[], rejected=0, error=None):
+		with self.lock:
+			self.pending -= delivered+len(failed)+rejected
+			self.delivered += delivered
+			self.failed += failed
+			if error != None:
+				self.error = error
+
+			if self.pending > 0:
+				return
+
+		self.done(self.delivered, self.failed, self.error)
 
 class Elasticsearch(Target):
-	def __init__(self, es_hosts, index_format="collector-%Y.%m.%d"):
-		Target.__init__(self, "Elasticsearch hosts="+str(es_hosts))
-		self.client = elasticsearch.Elasticsearch(es_hosts)
+	"""
+	Indexes documents through the bulk API. Documents are buffered and
+	flushed once bulk_docs documents or bulk_bytes bytes are buffered or the
+	oldest one waited bulk_latency seconds. Flushed requests are sent by
+	senders threads sharing a HostPool. Transport errors, overloaded hosts
+	and items rejected with a retryable status are retried up to retries
+	times with exponential backoff and jitter. push_confirmed reports the
+	outcome once the documents were sent.
+
+	Hosts are given as URLs, optionally with user and password for basic
+	authentication. HTTPS connections verify certificates against ca_certs
+	or the system CAs, unless verify_certs is False or an ssl_context is
+	given.
+	"""
+
+	# statuses of requests and bulk items worth retrying, e.g. a full write
+	# queue
+	RETRY_STATUS = [429, 502, 503, 504]
+	# statuses marking a host dead
+	DEAD_STATUS = [502, 503, 504]
+	BACKOFF = 0.1
+	MAX_BACKOFF = 10.0
+	# socket timeout if the target has no timeout
+	DEFAULT_TIMEOUT = 30.0
+
+	def __init__(self, es_hosts, index_format="collector-%Y.%m.%d", bulk_docs=1000, bulk_bytes=5242880, bulk_latency=1.0, retries=3, senders=1, ca_certs=None, verify_certs=True, ssl_context=None):
+		if type(es_hosts) == str:
+			es_hosts = [es_hosts]
+
+		if ssl_context == None:
+			ssl_context = ssl.create_default_context(cafile=ca_certs)
+			if not verify_certs:
+				ssl_context.check_hostname = False
+				ssl_context.verify_mode = ssl.CERT_NONE
+
+		self.pool = HostPool(es_hosts, ssl_context=ssl_context)
+		Target.__init__(self, "Elasticsearch hosts="+",".join([host_name(h) for h in self.pool.hosts]))
 		self.index_format = index_format
+		self.bulk_docs = bulk_docs
+		self.bulk_bytes = bulk_bytes
+		self.bulk_latency = bulk_latency
+		self.retries = retries
+		self.log = logging.getLogger(__name__)
+
+		# (document, serialized document, Confirmation or None), the index is
+		# set on flush
+		self.buffer = []
+		self.buffer_bytes = 0
+		self.buffer_since = None
+		self.lock = threading.RLock()
+		# counters of documents of all pushes, a Delivery counts the ones it
+		# pushed from their confirmations
+		self.indexed = 0
+		self.failed = 0
+		self.counter_lock = threading.Lock()
+
+		# flushed (index, items), bounded to hold back pushes while all
+		# senders are busy
+		self.requests = queue.Queue(maxsize=senders*2)
+		self.senders = []
+		for i in range(0, senders):
+			t = threading.Thread(target=self.send_loop, name="elasticsearch-send-%i" % (i), daemon=True)
+			t.start()
+			self.senders += [t]
+
+		self.closed = threading.Event()
+		self.flusher = threading.Thread(target=self.flush_late, name="elasticsearch-flush", daemon=True)
+		self.flusher.start()
 
 	def get_current_index(self):
 		return datetime.utcnow().strftime(self.index_format)
 
+	def add(self, doc, source, confirmation=None):
+		with self.lock:
+			if len(self.buffer) == 0:
+				self.buffer_since = time.monotonic()
+
+			self.buffer += [(doc, source, confirmation)]
+			self.buffer_bytes += len(source)
+
+			if len(self.buffer) >= self.bulk_docs or self.buffer_bytes >= self.bulk_bytes:
+				self.flush()
+
 	def push(self, doc):
-		self.client.index(
-			index=self.get_current_index(),
-			id=doc.id(),
-			doc_type=doc.type(),
-			body=doc.data(),
-		)
+		self.push_batch(DocumentBatch(doc.source, doc.envelope, [doc]))
+
+	def push_batch(self, batch):
+		for doc, source in json_documents(batch, lambda doc: { }):
+			self.add(doc, source)
+
+	def push_confirmed(self, batch, done):
+		if len(batch) == 0:
+			done(0, [], None)
+			return
+
+		confirmation = Confirmation(len(batch), done)
+		for doc, source in json_documents(batch, lambda doc: { }):
+			self.add(doc, source, confirmation)
+
+	def flush_late(self):
+		while not self.closed.wait(min(self.bulk_latency, 1.0)/2):
+			with self.lock:
+				if len(self.buffer) > 0 and time.monotonic()-self.buffer_since >= self.bulk_latency:
+					self.flush()
+
+	def flush(self):
+		"""
+		Hands the buffered documents to the senders.
+		"""
+		with self.lock:
+			items = self.buffer
+			self.buffer = []
+			self.buffer_bytes = 0
+			self.buffer_since = None
+
+			if len(items) > 0:
+				self.requests.put((self.get_current_index(), items))
+
+	def count(self, indexed, failed):
+		with self.counter_lock:
+			self.indexed += indexed
+			self.failed += failed
+
+	def settle(self, items, state, error=None):
+		"""
+		Reports items as "delivered", "failed" or "rejected" to the
+		confirmations of their batches.
+		"""
+		confirmations = { }
+
+		for doc, source, confirmation in items:
+			if confirmation == None:
+				continue
+
+			if id(confirmation) not in confirmations:
+				confirmations[id(confirmation)] = (confirmation, [])
+
+			confirmations[id(confirmation)][1].append(doc)
+
+		for confirmation, docs in confirmations.values():
+			if state == "delivered":
+				confirmation.settle(delivered=len(docs))
+			elif state == "failed":
+				confirmation.settle(failed=docs, error=error)
+			else:
+				confirmation.settle(rejected=len(docs))
+
+	def backoff(self, attempt):
+		# full jitter, senders retrying at once don't hit the hosts together
+		time.sleep(random.uniform(0, min(Elasticsearch.BACKOFF*2**attempt, Elasticsearch.MAX_BACKOFF)))
+
+	def send_loop(self):
+		while True:
+			r = self.requests.get()
+			if r == None:
+				return
+
+			index, items = r
+			try:
+				self.send(index, items)
+			except Exception as e:
+				self.log.exception("bulk request to %s failed", self.target)
+				self.give_up(items, e)
+
+	def post(self, body):
+		"""
+		Posts a bulk request, returns the status, the parsed response and the
+		exception of a transport error.
+		"""
+		timeout = self.timeout if self.timeout != None else Elasticsearch.DEFAULT_TIMEOUT
+		host, conn = self.pool.acquire(timeout)
+
+		headers = { "Content-Type": "application/x-ndjson" }
+		if host[3] != None:
+			headers["Authorization"] = host[3]
+
+		try:
+			conn.request("POST", "/_bulk", body=body, headers=headers)
+			response = conn.getresponse()
+			data = response.read()
+		except (OSError, http.client.HTTPException) as e:
+			self.log.warning("bulk request to %s:%i failed: %s", host[1], host[2], e)
+			self.pool.fail(host, conn)
+			return (None, None, e)
+
+		if response.status in Elasticsearch.DEAD_STATUS:
+			self.pool.fail(host, conn)
+		elif response.will_close:
+			conn.close()
+		else:
+			self.pool.release(host, conn)
+
+		if response.status >= 300:
+			return (response.status, None, None)
+
+		return (response.status, json.loads(data.decode("UTF-8")), None)
+
+	def send(self, index, items):
+		error = None
+
+		for attempt in range(0, self.retries+1):
+			if attempt > 0:
+				self.backoff(attempt)
+
+			body = []
+			for doc, source, confirmation in items:
+				body += [json.dumps({ "index": { "_index": index, "_type": doc.type(), "_id": doc.id() } }), source]
+
+			status, r, error = self.post(("\n".join(body)+"\n").encode("UTF-8"))
+
+			if r == None:
+				if error == None:
+					error = IOError("bulk request to %s rejected with status %i" % (self.target, status))
+					if status not in Elasticsearch.RETRY_STATUS:
+						self.log.warning("%s", error)
+						break
+
+				continue
+
+			if not r.get("errors", False):
+				self.count(len(items), 0)
+				self.settle(items, "delivered")
+				return
+
+			retry = []
+			indexed = []
+			rejected = []
+			for item, result in zip(items, r["items"]):
+				status = result.get("index", { }).get("status", 0)
+				if status < 300:
+					indexed += [item]
+				elif status in Elasticsearch.RETRY_STATUS:
+					retry += [item]
+				else:
+					rejected += [item]
+					self.log.warning("indexing %s failed: %s", item[0].id(), result.get("index", { }).get("error"))
+
+			self.count(len(indexed), len(rejected))
+			self.settle(indexed, "delivered")
+			self.settle(rejected, "rejected")
+
+			items = retry
+			if len(items) == 0:
+				return
+
+			error = IOError("%i documents rejected by %s" % (len(items), self.target))
+
+		self.give_up(items, error)
+
+	def give_up(self, items, error):
+		"""
+		Fails documents still not indexed after all retries.
+		"""
+		self.count(0, len(items))
+		self.settle(items, "failed", error)
+
+	def available(self):
+		return self.pool.available()
+
+	def close(self):
+		self.closed.set()
+		self.flush()
+
+		for t in self.senders:
+			self.requests.put(None)
+
+		for t in self.senders:
+			t.join()
 
+		self.pool.close()
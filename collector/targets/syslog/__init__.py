@@ -3,11 +3,12 @@
 
 from datetime import datetime
 from collector import Target, Document
-from collector.targets import datetime2iso_corrector
+from collector.targets import datetime2iso_corrector, json_documents
 import json
 from collector.targets.syslog.SyslogClient import SyslogClientRFC5424, SyslogClient
 import syslog
 import os
+import time
 
 class NetSyslogRFC5424(Target):
 	def __init__(self, host, port, proto="tcp", program="netsyslog"):
@@ -15,10 +16,41 @@ class NetSyslogRFC5424(Target):
 		self.program = program
 		self.client = SyslogClientRFC5424(host, port, proto=proto)
 
+	def connect(self):
+		"""
+		Connects the client, its socket times out after the timeout of the
+		target.
+		"""
+		if self.client.socket == None:
+			self.client.connect()
+
+		if self.client.socket == None:
+			raise ConnectionError("connecting to %s failed" % (self.target))
+
+		self.client.socket.settimeout(self.timeout)
+
+	def log(self, message, timestamp, start):
+		self.client.log(message, facility=SyslogClient.FAC_SYSLOG, severity=SyslogClient.SEV_DEBUG, program=self.program, pid=os.getpid(), timestamp=timestamp)
+
+		# the client closes its socket on errors, timeouts included
+		if self.timeout != None and time.monotonic()-start >= self.timeout:
+			raise TimeoutError("sending to %s timed out" % (self.target))
+
+		if self.client.socket == None:
+			raise ConnectionError("sending to %s failed" % (self.target))
+
 	def push(self, doc):
 		d = datetime2iso_corrector(doc.data())
 		d["type"] = doc.type()
-		self.client.log("@cee: %s" % (json.dumps(d)), facility=SyslogClient.FAC_SYSLOG, severity=SyslogClient.SEV_DEBUG, program=self.program, pid=os.getpid(), timestamp=datetime.utcnow())
+		self.connect()
+		self.log("@cee: %s" % (json.dumps(d)), datetime.utcnow(), time.monotonic())
+
+	def push_batch(self, batch):
+		timestamp = datetime.utcnow()
+		start = time.monotonic()
+		self.connect()
+		for doc, s in json_documents(batch, lambda doc: { "type": doc.type() }):
+			self.log("@cee: %s" % (s), timestamp, start)
 
 class Syslog(Target):
 	def __init__(self):
@@ -29,4 +61,8 @@ class Syslog(Target):
 		d["type"] = doc.type()
 		syslog.syslog("@cee: %s" % (json.dumps(d)))
 
+	def push_batch(self, batch):
+		for doc, s in json_documents(batch, lambda doc: { "type": doc.type() }):
+			syslog.syslog("@cee: %s" % (s))
+
 